@@ -20,10 +20,14 @@ import gzip
 import logging as log
 
 from .package import read_packages_dict_from_file
+from .utils import get_file_stamp, is_metainfo_file, is_interesting_file, is_image_file
 
 
 __all__ = list()
 
+# increase when the format of the Contents index changes, to force a rebuild
+CONTENTS_INDEX_VERSION = 3
+
 def _decode_contents_line(line):
     try:
         return str(line, 'utf-8')
@@ -31,18 +35,18 @@ def _decode_contents_line(line):
         return str(line, 'iso-8859-1')
 
 
-def _file_pkg_from_contents_line(raw_line):
+def _file_pkgs_from_contents_line(raw_line):
     line = raw_line.strip(' \t\n\r')
-    if not " " in line:
-        return (None, None)
-    parts = line.split(" ", 1)
+    parts = line.rsplit(None, 1)
+    if len(parts) != 2:
+        return (None, list())
     path = parts[0].strip()
-    group_pkg = parts[1].strip()
-    pkgname = group_pkg.split("/")[-1].strip()
-    return path, pkgname
+    # a file may be shipped by multiple packages: section/pkg1,section/pkg2
+    pkgnames = [group_pkg.split("/")[-1].strip() for group_pkg in parts[1].split(",")]
+    return path, pkgnames
 
 
-def parse_contents_file(mirror_dir, suite_name, component, arch_name):
+def _get_contents_fname(mirror_dir, suite_name, component, arch_name):
     contents_basename = "Contents-%s.gz" % (arch_name)
     contents_fname = os.path.join(mirror_dir, "dists", suite_name, component, contents_basename)
 
@@ -53,21 +57,83 @@ def parse_contents_file(mirror_dir, suite_name, component, arch_name):
         if os.path.isfile(path):
             contents_fname = path
 
-    # we want information about the whole package, not only the package-name
-    packages_dict = dict()
-    for name, pkg in read_packages_dict_from_file(mirror_dir, suite_name, component, arch_name).items():
-        pkg.filename = os.path.join(mirror_dir, pkg.filename)
-        packages_dict[name] = pkg
+    return contents_fname
+
 
-    # load and preprocess the large Contents file.
+def _read_contents_file(contents_fname):
     with gzip.open(contents_fname, 'r') as f:
         for line in f:
             line = _decode_contents_line(line)
-            fname, pkgname = _file_pkg_from_contents_line(line)
+            fname, pkgnames = _file_pkgs_from_contents_line(line)
+            if fname:
+                yield fname, pkgnames
+
+
+def update_contents_index(cache, mirror_dir, suite_name, component, arch_name):
+    '''
+    Ensure the index of interesting files (metainfo files, icons and other images) for the
+    Contents file of the given suite/component/arch in the cache is up to date.
+    The index is only rebuilt if the Contents or Packages file has changed.
+    Returns the key of the index, to be used with the DataCache.*contents_index* methods.
+    '''
+
+    key = "%s/%s/%s" % (suite_name, component, arch_name)
+    contents_fname = _get_contents_fname(mirror_dir, suite_name, component, arch_name)
+    packages_fname = os.path.join(mirror_dir, "dists", suite_name, component, "binary-%s" % (arch_name), "Packages.gz")
+
+    stamp = "%i;%s;%s" % (CONTENTS_INDEX_VERSION, get_file_stamp(contents_fname), get_file_stamp(packages_fname))
+    if cache.get_contents_index_stamp(key) == stamp:
+        return key
+
+    log.info("Updating Contents index for %s" % (key))
+    packages_dict = read_packages_dict_from_file(mirror_dir, suite_name, component, arch_name)
+
+    packages = dict()
+    files = dict()
+    for fname, pkgnames in _read_contents_file(contents_fname):
+        # images in the data directories might be icons referenced by their absolute path
+        interesting = is_interesting_file(fname) or is_image_file(fname)
+        for pkgname in pkgnames:
             pkg = packages_dict.get(pkgname)
             if not pkg:
                 continue
-            yield fname, pkg
+            if pkgname not in packages:
+                packages[pkgname] = (pkg.version, pkg.arch, pkg.filename)
+            if interesting:
+                files.setdefault(fname, list()).append(pkgname)
+
+    cache.set_contents_index(key, stamp, packages, files)
+    return key
+
+
+__all__.append('update_contents_index')
+
+
+def read_metainfo_files_index(cache, mirror_dir, suite_name, component, arch_name):
+    '''
+    Returns a dict of package-id -> list of .desktop/metainfo files for every package
+    listed in the Contents file, so we know which packages we need to look at without opening them.
+    Packages which don't contain any interesting file have an empty list.
+    '''
+
+    key = update_contents_index(cache, mirror_dir, suite_name, component, arch_name)
+
+    pkg_files = dict()
+    pkids = dict()
+    for pkgname, version, arch, fname in cache.get_contents_index_packages(key):
+        files = list()
+        pkg_files[pkgname] = files
+        pkids["%s/%s/%s" % (pkgname, version, arch)] = files
+
+    for fname, pkgnames in cache.get_contents_index_files(key):
+        if not is_metainfo_file(fname):
+            continue
+        for pkgname in pkgnames:
+            files = pkg_files.get(pkgname)
+            if files is not None:
+                files.append(fname)
+
+    return pkids
 
 
-__all__.append('parse_contents_file')
+__all__.append('read_metainfo_files_index')
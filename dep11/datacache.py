@@ -17,13 +17,25 @@
 
 import os
 import glob
+import json
 import shutil
+import threading
 import logging as log
 import lmdb
+from contextlib import contextmanager
 from math import pow
 import yaml
 
 
+# the suites database has one key "<pkid>\0<suite>/<component>/<arch>" per package
+# and suite it is in, and a reverse key "\1<suite>/<component>/<arch>\0<pkid>", so we
+# can list the packages of a suite. Old caches stored a YAML-encoded set per package instead.
+SUITES_FORMAT_KEY = b'\0format'
+SUITES_FORMAT = b'3'
+
+# the LMDB environments opened by this process
+_environments = dict()
+
 def tobytes(s):
     if isinstance(s, bytes):
         return s
@@ -37,37 +49,66 @@ class DataCache:
         self._hintsdb = None
         self._datadb = None
         self._statsdb = None
+        self._contentsdb = None
+        self._inputsdb = None
+        self._httpdb = None
         self._dbenv = None
         self.cache_dir = None
+        # screenshots are stored here once by content hash, the media
+        # directory only contains hardlinks to them
+        self.screenshot_dir = None
         self._opened = False
+        self._local = threading.local()
 
         self.media_dir = media_dir
 
         # set a huge map size to be futureproof.
         # This means we're cruel to non-64bit users, but this
         # software is supposed to be run on 64bit machines anyway.
-        self._map_size = pow(1024, 4)
+        self._map_size = int(pow(1024, 4))
 
 
     def open(self, cachedir):
-        self._dbenv = lmdb.open(cachedir, max_dbs=6, map_size=self._map_size, metasync=False)
-
-        self._pkgdb = self._dbenv.open_db(b'packages')
-        self._hintsdb = self._dbenv.open_db(b'hints')
-        self._datadb = self._dbenv.open_db(b'metadata')
-        self._statsdb = self._dbenv.open_db(b'statistics')
-        self._suitesdb = self._dbenv.open_db(b'suites')
-        self._langpacksdb = self._dbenv.open_db(b'langpacks')
+        # LMDB environments must only be opened once per process, so all caches
+        # using the same directory share one environment
+        path = os.path.abspath(cachedir)
+        env = _environments.get(path)
+        if not env:
+            dbenv = lmdb.open(cachedir, max_dbs=9, map_size=self._map_size, metasync=False)
+            dbs = dict()
+            for name in ('packages', 'hints', 'metadata', 'statistics', 'suites', 'langpacks', 'contents', 'inputs', 'http'):
+                dbs[name] = dbenv.open_db(tobytes(name))
+            env = {'env': dbenv, 'dbs': dbs, 'refs': 0}
+            _environments[path] = env
+        env['refs'] += 1
+
+        self._dbenv = env['env']
+        self._pkgdb = env['dbs']['packages']
+        self._hintsdb = env['dbs']['hints']
+        self._datadb = env['dbs']['metadata']
+        self._statsdb = env['dbs']['statistics']
+        self._suitesdb = env['dbs']['suites']
+        self._langpacksdb = env['dbs']['langpacks']
+        self._contentsdb = env['dbs']['contents']
+        self._inputsdb = env['dbs']['inputs']
+        self._httpdb = env['dbs']['http']
+        self._migrate_suites_db()
 
         self._opened = True
         self.cache_dir = cachedir
+        self.screenshot_dir = os.path.join(cachedir, "screenshots")
         return True
 
 
     def close(self):
         if not self._opened:
             return
-        self._dbenv.close()
+        path = os.path.abspath(self.cache_dir)
+        env = _environments[path]
+        env['refs'] -= 1
+        if env['refs'] <= 0:
+            del _environments[path]
+            self._dbenv.close()
 
         self._pkgdb = None
         self._hintsdb = None
@@ -76,6 +117,9 @@ class DataCache:
         self._statsdb = None
         self._suitesdb = None
         self._langpacksdb = None
+        self._contentsdb = None
+        self._inputsdb = None
+        self._httpdb = None
         self._opened = False
 
 
@@ -86,16 +130,76 @@ class DataCache:
         self.open(self.cache_dir)
 
 
+    def __getstate__(self):
+        # neither the LMDB environment nor the thread-local transaction state can travel
+        # to other processes, the cache needs to be reopened there.
+        state = self.__dict__.copy()
+        del state['_local']
+        for key in ('_dbenv', '_pkgdb', '_hintsdb', '_datadb', '_statsdb', '_suitesdb', '_langpacksdb', '_contentsdb', '_inputsdb', '_httpdb'):
+            state[key] = None
+        state['_opened'] = False
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+
+    @contextmanager
+    def batch(self):
+        '''
+        Run all cache operations of the current thread in a single write transaction,
+        which is committed when the block is left (or aborted, if it raises an exception).
+        Writes which happen in a loop should be wrapped in a batch, since every single
+        transaction commit costs us a sync of the database.
+        Nested batches are merged into the outermost one.
+        '''
+
+        txn = getattr(self._local, 'txn', None)
+        if txn:
+            yield txn
+            return
+
+        txn = self._dbenv.begin(write=True)
+        self._local.txn = txn
+        try:
+            yield txn
+        except:
+            txn.abort()
+            raise
+        else:
+            txn.commit()
+        finally:
+            self._local.txn = None
+
+
+    @contextmanager
+    def _begin(self, write=False):
+        '''
+        Get a transaction for a cache operation. Within a batch, the batch
+        transaction is reused, otherwise a new one is opened.
+        '''
+
+        txn = getattr(self._local, 'txn', None)
+        if txn:
+            yield txn
+            return
+
+        with self._dbenv.begin(write=write) as txn:
+            yield txn
+
+
     def metadata_exists(self, global_id):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb) as txn:
-            return txn.get(gid) != None
+        with self._begin() as txn:
+            return txn.get(gid, db=self._datadb) != None
 
 
     def get_metadata(self, global_id):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb) as dtxn:
-                d = dtxn.get(tobytes(gid))
+        with self._begin() as dtxn:
+                d = dtxn.get(tobytes(gid), db=self._datadb)
                 if not d:
                     return None
                 return str(d, 'utf-8')
@@ -103,52 +207,105 @@ class DataCache:
 
     def set_metadata(self, global_id, yaml_data):
         gid = tobytes(global_id)
-        with self._dbenv.begin(db=self._datadb, write=True) as txn:
-            txn.put(gid, tobytes(yaml_data))
+        with self._begin(write=True) as txn:
+            txn.put(gid, tobytes(yaml_data), db=self._datadb)
 
 
     def set_package_ignore(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-            txn.put(pkgid, b'ignore')
+        with self._begin(write=True) as txn:
+            txn.put(pkgid, b'ignore', db=self._pkgdb)
 
-    def package_in_suite(self, pkgid, suite):
-        pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._suitesdb) as txn:
-            yaml_suites = txn.get(pkgid)
+    def _migrate_suites_db(self):
+        """
+        Convert the suites database from older formats, which stored a YAML-encoded
+        set of suites per package or had no suite -> package index, to the current one.
+        """
 
-            if not yaml_suites:
-                return False
+        with self._dbenv.begin() as txn:
+            if txn.get(SUITES_FORMAT_KEY, db=self._suitesdb) == SUITES_FORMAT:
+                return
 
-            suites = yaml.load(yaml_suites)
+        with self._dbenv.begin(write=True) as txn:
+            old_entries = list()
+            pkg_suites = list()
+            cursor = txn.cursor(db=self._suitesdb)
+            for key, value in cursor:
+                if key.startswith(b'\0') or key.startswith(b'\1'):
+                    continue
+                if b'\0' in key:
+                    pkg_suites.append(key.split(b'\0', 1))
+                else:
+                    old_entries.append((key, value))
 
-            return suite in suites
+            if old_entries:
+                log.info("Converting suites data of %i packages to the new cache format." % (len(old_entries)))
+            for pkgid, yaml_suites in old_entries:
+                suites = yaml.safe_load(yaml_suites)
+                txn.delete(pkgid, db=self._suitesdb)
+                for suite in (suites or []):
+                    pkg_suites.append((pkgid, tobytes(suite)))
+
+            for pkgid, suite in pkg_suites:
+                txn.put(pkgid + b'\0' + suite, b'', db=self._suitesdb)
+                txn.put(b'\1' + suite + b'\0' + pkgid, b'', db=self._suitesdb)
+
+            txn.put(SUITES_FORMAT_KEY, SUITES_FORMAT, db=self._suitesdb)
+
+    def package_in_suite(self, pkgid, suite):
+        key = tobytes(pkgid) + b'\0' + tobytes(suite)
+        with self._begin() as txn:
+            return txn.get(key, db=self._suitesdb) != None
 
     def add_package_to_suite(self, pkgid, suite):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._suitesdb, write=True) as txn:
-            suites = txn.get(pkgid)
-            if not suites:
-                suites = set()
-            else:
-                suites = yaml.load(suites)
-            suites.add(suite)
-            txn.put(pkgid, tobytes(yaml.dump(suites)))
+        suite = tobytes(suite)
+        with self._begin(write=True) as txn:
+            txn.put(pkgid + b'\0' + suite, b'', db=self._suitesdb)
+            txn.put(b'\1' + suite + b'\0' + pkgid, b'', db=self._suitesdb)
 
     def remove_package_from_suite(self, pkgid, suite):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._suitesdb, write=True) as txn:
-            suites = txn.get(pkgid)
-            if not suites:
-                return
-            suites = yaml.load(suites)
-            suites.discard(suite)
-            txn.put(pkgid, tobytes(yaml.dump(suites)))
+        suite = tobytes(suite)
+        with self._begin(write=True) as txn:
+            txn.delete(pkgid + b'\0' + suite, db=self._suitesdb)
+            txn.delete(b'\1' + suite + b'\0' + pkgid, db=self._suitesdb)
+
+    def get_suite_packages(self, suite):
+        """
+        Return the set of IDs of all packages registered with the given suite/component/arch.
+        """
+
+        prefix = b'\1' + tobytes(suite) + b'\0'
+        pkgids = set()
+        with self._begin() as txn:
+            cursor = txn.cursor(db=self._suitesdb)
+            if not cursor.set_range(prefix):
+                return pkgids
+            for key in cursor.iternext(values=False):
+                if not key.startswith(prefix):
+                    break
+                pkgids.add(str(key[len(prefix):], 'utf-8'))
+        return pkgids
+
+    def _remove_package_suites(self, txn, pkgid):
+        prefix = pkgid + b'\0'
+        suites = list()
+        cursor = txn.cursor(db=self._suitesdb)
+        if cursor.set_range(prefix):
+            for key in cursor.iternext(values=False):
+                if not key.startswith(prefix):
+                    break
+                suites.append(key[len(prefix):])
+
+        for suite in suites:
+            txn.delete(prefix + suite, db=self._suitesdb)
+            txn.delete(b'\1' + suite + b'\0' + pkgid, db=self._suitesdb)
 
     def get_cpt_gids_for_pkg(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            cs_str = txn.get(pkgid)
+        with self._begin() as txn:
+            cs_str = txn.get(pkgid, db=self._pkgdb)
             if not cs_str:
                 return None
             cs_str = str(cs_str, 'utf-8')
@@ -171,48 +328,79 @@ class DataCache:
         return data
 
 
-    def set_components(self, pkgid, cpts):
-        # if the package has no components,
-        # mark it as always-ignore
-        if len(cpts) == 0:
-            self.set_package_ignore(pkgid)
-            return
-
-        pkgid = tobytes(pkgid)
+    def serialize_components(self, cpts):
+        """
+        Convert a list of components into plain data which can be passed between processes
+        and stored later using set_components_data().
+        Returns a list of (global-id, metadata YAML, hints YAML) tuples. The global-id is None
+        for ignored components, the metadata is None if it is in the cache already.
+        """
 
-        gids = list()
-        hints_str = ""
+        cpts_data = list()
         for cpt in cpts:
+            gid = None
+            md_yaml = None
             # check for ignore-reasons first, to avoid a database query
             if not cpt.has_ignore_reason():
                 if self.metadata_exists(cpt.global_id):
-                    gids.append(cpt.global_id)
+                    gid = cpt.global_id
                 else:
                     # get the metadata in YAML format
                     md_yaml = cpt.to_yaml_doc()
                     # we need to check for ignore reasons again, since generating
                     # the YAML doc may have raised more errors
                     if not cpt.has_ignore_reason():
-                        self.set_metadata(cpt.global_id, md_yaml)
-                        gids.append(cpt.global_id)
-
-            hints_yml = cpt.get_hints_yaml()
-            if hints_yml:
-                hints_str += hints_yml
-
-        self.set_hints(pkgid, hints_str)
-        if gids:
-            with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-                txn.put(pkgid, bytes("\n".join(gids), 'utf-8'))
-        elif hints_str:
-            # we need to set some value for this package, to show that we've seen it
-            with self._dbenv.begin(db=self._pkgdb, write=True) as txn:
-                txn.put(pkgid, b'seen')
+                        gid = cpt.global_id
+                    else:
+                        md_yaml = None
+
+            cpts_data.append((gid, md_yaml, cpt.get_hints_yaml()))
+        return cpts_data
+
+
+    def set_components_data(self, pkgid, cpts_data):
+        """
+        Store components of a package which have been serialized with serialize_components().
+        """
+
+        # if the package has no components,
+        # mark it as always-ignore
+        if len(cpts_data) == 0:
+            self.set_package_ignore(pkgid)
+            return
+
+        pkgid = tobytes(pkgid)
+
+        gids = list()
+        hints_str = ""
+        with self.batch():
+            for gid, md_yaml, hints_yml in cpts_data:
+                if gid:
+                    # another package might have added the same component in the meantime,
+                    # the first one wins
+                    if md_yaml and not self.metadata_exists(gid):
+                        self.set_metadata(gid, md_yaml)
+                    gids.append(gid)
+                if hints_yml:
+                    hints_str += hints_yml
+
+            self.set_hints(pkgid, hints_str)
+            if gids:
+                with self._begin(write=True) as txn:
+                    txn.put(pkgid, bytes("\n".join(gids), 'utf-8'), db=self._pkgdb)
+            elif hints_str:
+                # we need to set some value for this package, to show that we've seen it
+                with self._begin(write=True) as txn:
+                    txn.put(pkgid, b'seen', db=self._pkgdb)
+
+
+    def set_components(self, pkgid, cpts):
+        self.set_components_data(pkgid, self.serialize_components(cpts))
 
     def get_hints(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._hintsdb) as txn:
-            hints = txn.get(pkgid)
+        with self._begin() as txn:
+            hints = txn.get(pkgid, db=self._hintsdb)
             if hints:
                 hints = str(hints, 'utf-8')
             return hints
@@ -220,8 +408,8 @@ class DataCache:
 
     def set_hints(self, pkgid, hints_yml):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._hintsdb, write=True) as txn:
-            txn.put(pkgid, tobytes(hints_yml))
+        with self._begin(write=True) as txn:
+            txn.put(pkgid, tobytes(hints_yml), db=self._hintsdb)
 
 
     def _cleanup_empty_dirs(self, d):
@@ -237,32 +425,30 @@ class DataCache:
     def remove_package(self, pkgid):
         log.debug("Dropping package: %s" % (pkgid))
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb, write=True) as pktxn:
-            pktxn.delete(pkgid)
-        with self._dbenv.begin(db=self._hintsdb, write=True) as htxn:
-            htxn.delete(pkgid)
-        with self._dbenv.begin(db=self._suitesdb, write=True) as stxn:
-            stxn.delete(pkgid)
+        with self._begin(write=True) as txn:
+            txn.delete(pkgid, db=self._pkgdb)
+            txn.delete(pkgid, db=self._hintsdb)
+            self._remove_package_suites(txn, pkgid)
 
 
     def is_ignored(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            return txn.get(pkgid) == b'ignore'
+        with self._begin() as txn:
+            return txn.get(pkgid, db=self._pkgdb) == b'ignore'
 
 
     def package_exists(self, pkgid):
         pkgid = tobytes(pkgid)
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            return txn.get(pkgid) != None
+        with self._begin() as txn:
+            return txn.get(pkgid, db=self._pkgdb) != None
 
 
     def get_packages_not_in_set(self, pkgset):
         res = set()
         if not pkgset:
             pkgset = set()
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            cursor = txn.cursor()
+        with self._begin() as txn:
+            cursor = txn.cursor(db=self._pkgdb)
             for key, value in cursor:
                 if not str(key, 'utf-8') in pkgset:
                     res.add(key)
@@ -289,8 +475,8 @@ class DataCache:
         """
         gid_pkg = dict()
 
-        with self._dbenv.begin(db=self._pkgdb) as txn:
-            cursor = txn.cursor()
+        with self._begin() as txn:
+            cursor = txn.cursor(db=self._pkgdb)
             for key, value in cursor:
                 if not value or value == b'ignore' or value == b'seen':
                     continue
@@ -302,8 +488,9 @@ class DataCache:
                     gid_pkg[gid].append(key)
 
         # remove the media and component data, if component is orphaned
-        with self._dbenv.begin(db=self._datadb) as dtxn:
-            cursor = dtxn.cursor()
+        orphaned_gids = list()
+        with self._begin() as dtxn:
+            cursor = dtxn.cursor(db=self._datadb)
             for gid, yaml in cursor:
                 gid = str(gid, 'utf-8')
 
@@ -311,14 +498,16 @@ class DataCache:
                 pkgs = gid_pkg.get(gid)
                 if pkgs:
                     continue
+                orphaned_gids.append(gid)
 
+        with self.batch() as dtxn:
+            for gid in orphaned_gids:
                 # drop cached media
                 if self._remove_media_for_gid(gid):
                     log.info("Expired media: %s" % (gid))
 
                 # drop component from db
-                with self._dbenv.begin(db=self._datadb, write=True) as dtxn:
-                    dtxn.delete(tobytes(gid))
+                dtxn.delete(tobytes(gid), db=self._datadb)
 
 
     def remove_orphaned_media(self):
@@ -354,19 +543,103 @@ class DataCache:
                 if self._remove_media_for_gid(cptid):
                     log.info("Removed orphaned media: %s" % (cptid))
 
+        self._remove_orphaned_screenshot_blobs()
+
+
+    def get_screenshot_blob_dir(self, sha256):
+        """
+        Return the directory in the screenshot store which holds the source
+        image with the given hash and its thumbnails.
+        """
+        return os.path.join(self.screenshot_dir, sha256[:2], sha256)
+
+
+    def remove_screenshot_blob(self, sha256):
+        blob_dir = self.get_screenshot_blob_dir(sha256)
+        if os.path.isdir(blob_dir):
+            shutil.rmtree(blob_dir)
+        parent = os.path.dirname(blob_dir)
+        if os.path.isdir(parent) and not os.listdir(parent):
+            os.rmdir(parent)
+
+
+    def _remove_orphaned_screenshot_blobs(self):
+        """
+        Remove screenshots from the store which are not used by any component anymore.
+        The hardlinks in the media directory are the references to a stored screenshot,
+        so one which has no other links left isn't needed anymore.
+        If the media directory is on another filesystem, every screenshot is copied
+        instead and the store doesn't save us anything, so we don't keep it around then.
+        """
+        if not self.screenshot_dir or not os.path.isdir(self.screenshot_dir):
+            return
+
+        for prefix in os.listdir(self.screenshot_dir):
+            prefix_dir = os.path.join(self.screenshot_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for sha256 in os.listdir(prefix_dir):
+                blob_dir = os.path.join(prefix_dir, sha256)
+                in_use = False
+                for fname in os.listdir(blob_dir):
+                    if os.stat(os.path.join(blob_dir, fname)).st_nlink > 1:
+                        in_use = True
+                        break
+                if not in_use:
+                    self.remove_screenshot_blob(sha256)
+                    log.info("Removed unused screenshot: %s" % (sha256))
+
+
+    def get_http_cache_entry(self, url):
+        """
+        Return what we know about the file we downloaded from 'url' the last time, as dict with
+        the keys 'etag', 'last_modified', 'sha256' and 'path' (relative to the screenshot store),
+        plus further data which depends on the kind of file.
+        """
+
+        with self._begin() as txn:
+            entry = txn.get(tobytes(url), db=self._httpdb)
+            if not entry:
+                return None
+            return json.loads(str(entry, 'utf-8'))
+
+
+    def set_http_cache_entry(self, url, entry):
+        with self._begin(write=True) as txn:
+            txn.put(tobytes(url), tobytes(json.dumps(entry)), db=self._httpdb)
+
+
+    def remove_orphaned_http_cache_entries(self):
+        """
+        Forget downloads whose files don't exist anymore.
+        """
+
+        if not self.screenshot_dir:
+            return
+
+        with self.batch() as txn:
+            cursor = txn.cursor(db=self._httpdb)
+            stale = list()
+            for url, entry in cursor:
+                path = json.loads(str(entry, 'utf-8')).get('path')
+                if not path or not os.path.isfile(os.path.join(self.screenshot_dir, path)):
+                    stale.append(url)
+            for url in stale:
+                txn.delete(url, db=self._httpdb)
+
 
     def set_stats(self, timestamp, data):
         data = tobytes(data)
         tstamp = timestamp.to_bytes(10, byteorder='big')
-        with self._dbenv.begin(db=self._statsdb, write=True) as txn:
-            txn.put(tstamp, data)
+        with self._begin(write=True) as txn:
+            txn.put(tstamp, data, db=self._statsdb)
 
 
     def get_stats(self):
         stats = dict()
 
-        with self._dbenv.begin(db=self._statsdb) as txn:
-            cursor = txn.cursor()
+        with self._begin() as txn:
+            cursor = txn.cursor(db=self._statsdb)
             for key, value in cursor:
                 if not value:
                     continue
@@ -384,29 +657,34 @@ class DataCache:
 
         data_removed = False
 
-        with self._dbenv.begin(db=self._pkgdb, write=True) as pktxn:
-            cursor = pktxn.cursor()
+        with self._begin(write=True) as pktxn:
+            cursor = pktxn.cursor(db=self._pkgdb)
             for pkid, data in cursor:
                 pkid_str = str(pkid, 'utf-8')
                 if pkid_str.startswith(pkgname+'/'):
-                     pktxn.delete(pkid)
+                     pktxn.delete(pkid, db=self._pkgdb)
                      data_removed = True
 
-        with self._dbenv.begin(db=self._hintsdb, write=True) as htxn:
-            cursor = htxn.cursor()
+        with self._begin(write=True) as htxn:
+            cursor = htxn.cursor(db=self._hintsdb)
             for pkid, data in cursor:
                 pkid_str = str(pkid, 'utf-8')
                 if pkid_str.startswith(pkgname+'/'):
-                     htxn.delete(pkid)
+                     htxn.delete(pkid, db=self._hintsdb)
                      data_removed = True
 
-        with self._dbenv.begin(db=self._suitesdb, write=True) as stxn:
-            cursor = stxn.cursor()
-            for pkid, data in cursor:
-                pkid_str = str(pkid, 'utf-8')
-                if pkid_str.startswith(pkgname+'/'):
-                     stxn.delete(pkid)
-                     data_removed = True
+        with self._begin(write=True) as stxn:
+            # the suites database uses "<pkid>\0<suite>" keys
+            pkgids = set()
+            cursor = stxn.cursor(db=self._suitesdb)
+            if cursor.set_range(tobytes(pkgname+'/')):
+                for key in cursor.iternext(values=False):
+                    if not key.startswith(tobytes(pkgname+'/')):
+                        break
+                    pkgids.add(key.split(b'\0', 1)[0])
+            for pkid in pkgids:
+                self._remove_package_suites(stxn, pkid)
+                data_removed = True
 
         return data_removed
 
@@ -416,8 +694,8 @@ class DataCache:
         Return a dict with some information we have about the package in the cache.
         """
 
-        with self._dbenv.begin(db=self._pkgdb, write=True) as pktxn:
-            cursor = pktxn.cursor()
+        with self._begin(write=True) as pktxn:
+            cursor = pktxn.cursor(db=self._pkgdb)
             for pkid, data in cursor:
                 pkid_str = str(pkid, 'utf-8')
                 data = str(data, 'utf-8')
@@ -428,11 +706,138 @@ class DataCache:
     def update_langpack(self, langpack, version):
         langpack = tobytes(langpack)
         version = tobytes(version)
-        with self._dbenv.begin(db=self._langpacksdb, write=True) as txn:
-            old_version = txn.get(langpack)
-            txn.put(langpack, version)
+        with self._begin(write=True) as txn:
+            old_version = txn.get(langpack, db=self._langpacksdb)
+            txn.put(langpack, version, db=self._langpacksdb)
 
             if not old_version or version != old_version:
                 return False
 
             return True
+
+
+    def get_contents_index_stamp(self, key):
+        key = tobytes(key)
+        with self._begin() as txn:
+            stamp = txn.get(key, db=self._contentsdb)
+            if not stamp:
+                return None
+            return str(stamp, 'utf-8')
+
+
+    def set_contents_index(self, key, stamp, packages, files):
+        """
+        Replace the Contents index with the given key.
+        'packages' is a dict of package name -> (version, arch, filename) of all packages
+        listed in the Contents file, 'files' a dict of file path -> list of package names
+        for the files we want to be able to look up.
+        """
+
+        key = tobytes(key)
+        pkg_prefix = key + b'\1'
+        file_prefix = key + b'\0'
+        with self._begin(write=True) as txn:
+            cursor = txn.cursor(db=self._contentsdb)
+            # drop the old index data
+            for prefix in (file_prefix, pkg_prefix):
+                if not cursor.set_range(prefix):
+                    continue
+                while cursor.key().startswith(prefix):
+                    if not cursor.delete():
+                        break
+
+            cursor.putmulti((pkg_prefix + tobytes(name), tobytes("\n".join(info))) for name, info in packages.items())
+            cursor.putmulti((file_prefix + tobytes(fname), tobytes("\n".join(pkgnames))) for fname, pkgnames in files.items())
+            txn.put(key, tobytes(stamp), db=self._contentsdb)
+
+
+    def get_contents_index_packages(self, key):
+        """
+        Yield (name, version, arch, filename) for all packages in the Contents index with the given key.
+        """
+
+        prefix = tobytes(key) + b'\1'
+        with self._begin() as txn:
+            cursor = txn.cursor(db=self._contentsdb)
+            if not cursor.set_range(prefix):
+                return
+            for pkgname, info in cursor:
+                if not pkgname.startswith(prefix):
+                    break
+                version, arch, fname = str(info, 'utf-8').split("\n")
+                yield str(pkgname[len(prefix):], 'utf-8'), version, arch, fname
+
+
+    def get_contents_index_package(self, key, pkgname):
+        """
+        Return (version, arch, filename) of a package in the Contents index with the given key.
+        """
+
+        with self._begin() as txn:
+            info = txn.get(tobytes(key) + b'\1' + tobytes(pkgname), db=self._contentsdb)
+            if not info:
+                return None
+            return tuple(str(info, 'utf-8').split("\n"))
+
+
+    def get_contents_index_files(self, key):
+        """
+        Yield (path, list of package names) for all files in the Contents index with the given key.
+        """
+
+        prefix = tobytes(key) + b'\0'
+        with self._begin() as txn:
+            cursor = txn.cursor(db=self._contentsdb)
+            if not cursor.set_range(prefix):
+                return
+            for fname, pkgnames in cursor:
+                if not fname.startswith(prefix):
+                    break
+                yield str(fname[len(prefix):], 'utf-8'), str(pkgnames, 'utf-8').split("\n")
+
+
+    def find_contents_index_file(self, key, fname):
+        """
+        Return the names of the packages containing the file 'fname', according to the Contents
+        index with the given key.
+        """
+
+        with self._begin() as txn:
+            pkgnames = txn.get(tobytes(key) + b'\0' + tobytes(fname), db=self._contentsdb)
+            if not pkgnames:
+                return None
+            return str(pkgnames, 'utf-8').split("\n")
+
+
+    def get_input_stamp(self, key):
+        """
+        Return the stamp of the archive index files which were used to generate
+        the data for 'key' (usually a suite/arch) the last time.
+        """
+
+        with self._begin() as txn:
+            stamp = txn.get(tobytes(key), db=self._inputsdb)
+            if not stamp:
+                return None
+            return str(stamp, 'utf-8')
+
+
+    def set_input_stamp(self, key, stamp):
+        with self._begin(write=True) as txn:
+            txn.put(tobytes(key), tobytes(stamp), db=self._inputsdb)
+
+
+    def clear_input_stamps(self, prefix=''):
+        """
+        Forget the input stamps of all keys starting with 'prefix', so the next
+        run will look at the data again.
+        """
+
+        prefix = tobytes(prefix)
+        with self._begin(write=True) as txn:
+            cursor = txn.cursor(db=self._inputsdb)
+            if not cursor.set_range(prefix):
+                return
+            while cursor.key().startswith(prefix):
+                if not cursor.delete():
+                    break
@@ -18,6 +18,24 @@
 import os
 import apt_inst
 
+from .utils import is_interesting_file
+
+
+def _normalize_member_name(fname):
+    # strip / from the start of the filename (doesn't and shouldn't exist in .deb payload)
+    if fname.startswith('/'):
+        fname = fname[1:]
+    return fname
+
+
+def _resolve_symlink(fname, target):
+    if target.startswith('/'):
+        # absolute path
+        return target[1:]
+    # relative path
+    return os.path.normpath(os.path.join(fname, '..', target))
+
+
 class DebFile:
     """
     Represents a .deb file.
@@ -27,6 +45,10 @@ class DebFile:
         self._deb = apt_inst.DebFile(fname)
         self._filelist = None
 
+        # members kept by scan_interesting()
+        self._members_data = dict()
+        self._members_links = dict()
+
     def extract(self, directory):
         self._deb.data.extractall(directory)
 
@@ -48,32 +70,102 @@ class DebFile:
         return self._filelist
 
 
-    def get_file_data(self, fname):
-        """
-        Extract data from a .deb file, following symlinks.
-        """
-
-        # strip / from the start of the filename (doesn't and shouldn't exist in .deb payload)
-        if fname.startswith('/'):
-                fname = fname[1:]
+    def _read_members(self, wanted, fdata, links, keep=None):
+        '''
+        Walk the data tarball once, storing the data of all members in 'wanted' (or accepted
+        by the 'keep' function) in 'fdata'.
+        Symlinks are recorded in 'links', and their targets are added to the wanted set,
+        so targets which come after the link in the tarball are picked up in the same pass.
+        '''
 
-        fdata = None
-        symlink_target = None
+        files = list()
         def handle_data(member, data):
-            nonlocal symlink_target, fdata
+            name = member.name
+            files.append(name)
+            if name not in wanted and not (keep and keep(name)):
+                return
             if member.issym():
-                symlink_target = member.linkname
-                if symlink_target.startswith('/'):
-                    # absolute path
-                    symlink_target = symlink_target[1:]
-                else:
-                    # relative path
-                    symlink_target = os.path.normpath(os.path.join(fname, '..', symlink_target))
+                target = _resolve_symlink(name, member.linkname)
+                links[name] = target
+                if target not in fdata:
+                    wanted.add(target)
                 return
-            fdata = data
+            fdata[name] = data
+
+        self._deb.data.go(handle_data)
+
+        # we have seen every member, so we got the list of files for free
+        self._filelist = files
+
+
+    def scan_interesting(self):
+        '''
+        Walk the data tarball once, recording the list of all files and keeping the data
+        of every member which is interesting for DEP-11 (.desktop files, metainfo files and icons).
+        Subsequent calls to get_files_data() for these files don't need to read the package again.
+        Returns the list of all files in the package.
+        '''
+
+        fdata = dict()
+        links = dict()
+        self._read_members(set(), fdata, links, keep=is_interesting_file)
+
+        self._members_data = fdata
+        self._members_links = links
+        return self._filelist
+
+
+    def get_files_data(self, fnames):
+        """
+        Extract data for multiple files from a .deb file, following symlinks.
+        The data tarball is only decompressed once for all requested files, unless
+        a symlink points at a file we have already passed, and not at all if all files
+        were kept by a previous scan_interesting() call.
+        Returns a dict of filename -> data (or None, if the data could not be found).
+        """
+
+        names = dict((fname, _normalize_member_name(fname)) for fname in fnames)
+
+        fdata = dict(self._members_data)
+        links = dict(self._members_links)
+
+        def follow(name):
+            seen = set()
+            while name in links and name not in seen:
+                seen.add(name)
+                name = links[name]
+            return name
+
+        # read the package again for everything we don't have yet. Symlink targets which
+        # appeared before their link in the tarball need another pass, but we do that only
+        # once for all of them.
+        tried = set()
+        def find_missing():
+            missing = set()
+            for name in names.values():
+                target = follow(name)
+                if target in fdata or target in tried:
+                    continue
+                if self._filelist is not None and target not in self._filelist:
+                    continue
+                missing.add(target)
+            return missing
+
+        missing = find_missing()
+        while missing:
+            tried.update(missing)
+            self._read_members(missing, fdata, links)
+            missing = find_missing()
+
+        res = dict()
+        for fname, name in names.items():
+            res[fname] = fdata.get(follow(name))
+        return res
+
+
+    def get_file_data(self, fname):
+        """
+        Extract data from a .deb file, following symlinks.
+        """
 
-        self._deb.data.go(handle_data, fname)
-        if not fdata and symlink_target:
-            # we have a symlink, try to follow it
-            self._deb.data.go(handle_data, symlink_target)
-        return fdata
+        return self.get_files_data([fname]).get(fname)
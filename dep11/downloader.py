@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import ssl
+import time
+import threading
+import http.client
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Response:
+    '''
+    The result of a download.
+    '''
+
+    def __init__(self, url, status, headers, data):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+
+def create_ssl_context():
+    '''
+    Create the SSL context for connections to upstream sites.
+    '''
+
+    # The Debian services use a custom setup for SSL verification, not trusting global CAs and
+    # only Debian itself. If we are running on such a setup, ensure we load the global CA certs
+    # in order to establish HTTPS connections to foreign services.
+    # For more information, see https://wiki.debian.org/ServicesSSL
+    ca_path = '/etc/ssl/ca-global'
+    if os.path.isdir(ca_path):
+        return ssl.create_default_context(capath=ca_path)
+    return ssl.create_default_context()
+
+
+class Downloader:
+    '''
+    Fetches files via HTTP(S) in the background, using a pool of threads.
+    Connections to a host are kept open and reused, the number of parallel
+    connections to a single host is limited, and all downloads which are
+    not finished by the (optional) deadline fail.
+    '''
+
+    def __init__(self, max_downloads=8, max_per_host=2, timeout=30, deadline=None):
+        '''
+        'deadline' is the time (in seconds since the epoch) after which all downloads fail.
+        '''
+
+        self._timeout = timeout
+        self._deadline = deadline
+        self._max_per_host = max_per_host
+        self._ssl_context = create_ssl_context()
+        self._executor = ThreadPoolExecutor(max_downloads)
+
+        self._lock = threading.Condition()
+        # the number of running requests and the requests waiting for a free slot, by (scheme, host, port).
+        # Requests only get a thread once their host has a free slot, so the threads are never
+        # blocked by waiting for a busy host while downloads from other hosts could run.
+        self._running = dict()
+        self._queued = dict()
+        # idle connections, by (scheme, host, port)
+        self._connections = defaultdict(list)
+
+        # seconds spent downloading
+        self.busy_time = 0
+
+
+    def fetch(self, url, headers=None):
+        '''
+        Start downloading 'url'. Returns a future, which resolves to a Response or raises
+        a DownloadError.
+        '''
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._submit(url, headers or dict(), future, 0)
+        return future
+
+
+    def _time_left(self):
+        if not self._deadline:
+            return None
+        left = self._deadline - time.time()
+        if left <= 0:
+            raise DownloadError("Download deadline exceeded.")
+        return left
+
+
+    def _set_timeout(self, conn):
+        '''
+        Limit the time the next operation on 'conn' may block to the time left until the deadline.
+        '''
+
+        timeout = self._timeout
+        left = self._time_left()
+        if left is not None:
+            timeout = min(timeout, left)
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+
+
+    def _read_body(self, conn, resp):
+        # read in chunks, so a slow server can't keep us busy beyond the deadline
+        chunks = list()
+        while True:
+            self._set_timeout(conn)
+            chunk = resp.read1(64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        # this finishes the response, so the connection can be reused
+        chunks.append(resp.read())
+        return b''.join(chunks)
+
+
+    def _get_connection(self, key):
+        with self._lock:
+            if self._connections[key]:
+                return self._connections[key].pop(), True
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self._timeout, context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self._timeout)
+        return conn, False
+
+
+    def _release_connection(self, key, conn):
+        with self._lock:
+            self._connections[key].append(conn)
+
+
+    def _submit(self, url, headers, future, redirects):
+        '''
+        Run the request for 'url' as soon as there is a free slot for its host,
+        and resolve 'future' with its result.
+        '''
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            future.set_exception(DownloadError("Unsupported URL scheme: %s" % (parts.scheme)))
+            return
+        if not parts.hostname:
+            future.set_exception(DownloadError("Invalid URL: %s" % (url)))
+            return
+
+        key = (parts.scheme, parts.hostname, parts.port)
+        request = (key, url, headers, future, redirects)
+        with self._lock:
+            running = self._running.get(key, 0)
+            if running >= self._max_per_host:
+                self._queued.setdefault(key, deque()).append(request)
+                return
+            self._running[key] = running + 1
+        self._executor.submit(self._run, request)
+
+
+    def _release_slot(self, key):
+        '''
+        Hand the slot of a finished request for host 'key' on to the next request waiting for it.
+        '''
+
+        with self._lock:
+            queued = self._queued.get(key)
+            if not queued:
+                self._running[key] -= 1
+                if not self._running[key]:
+                    del self._running[key]
+                    self._lock.notify_all()
+                return
+            request = queued.popleft()
+            if not queued:
+                del self._queued[key]
+        self._executor.submit(self._run, request)
+
+
+    def _run(self, request):
+        key, url, headers, future, redirects = request
+        start = time.time()
+        resp = None
+        error = None
+        try:
+            resp = self._request(key, url, headers)
+        except DownloadError as e:
+            error = e
+        except Exception as e:
+            error = DownloadError(str(e))
+            error.__cause__ = e
+        with self._lock:
+            self.busy_time += time.time() - start
+
+        try:
+            # follow redirects, like urllib does
+            if resp is not None:
+                location = resp.headers.get('Location')
+                if resp.status in (301, 302, 303, 307, 308) and location:
+                    if redirects >= 10:
+                        error = DownloadError("Too many redirects.")
+                    else:
+                        # queue the redirect before releasing our slot, so we are never idle in between
+                        self._submit(urljoin(url, location), headers, future, redirects + 1)
+                        return
+        finally:
+            self._release_slot(key)
+
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(resp)
+
+
+    def _request(self, key, url, headers):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            conn, reused = self._get_connection(key)
+            try:
+                # connecting and waiting for the reply must not take longer than we have left.
+                # This also fails requests which waited for a free slot until the deadline passed.
+                self._set_timeout(conn)
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                data = self._read_body(conn, resp)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # the server might have closed an idle connection, retry with a new one
+                if reused:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release_connection(key, conn)
+            return Response(url, resp.status, resp.headers, data)
+
+
+    def close(self):
+        '''
+        Wait for all downloads to finish and close all connections.
+        '''
+
+        with self._lock:
+            self._lock.wait_for(lambda: not self._running)
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conns in self._connections.values():
+                for conn in conns:
+                    conn.close()
+            self._connections.clear()
+
+
+# the downloader used by everything in this process
+_downloader = None
+_downloader_deadline = None
+
+def set_download_deadline(deadline):
+    '''
+    Set the time (in seconds since the epoch) after which all downloads of the downloader
+    returned by get_downloader() fail.
+    '''
+
+    global _downloader_deadline
+    _downloader_deadline = deadline
+
+
+def get_downloader():
+    '''
+    Returns the downloader shared by everything in this process, so connections to
+    upstream hosts can be reused for all packages.
+    '''
+
+    global _downloader
+    if not _downloader:
+        _downloader = Downloader(deadline=_downloader_deadline)
+    return _downloader
@@ -17,15 +17,13 @@
 # License along with this program.
 
 import os
-import urllib.request
-import ssl
 import yaml
-
-from PIL import Image
 import logging as log
 
 from .component import Component
 from .parsers import read_desktop_data, read_appstream_upstream_xml
+from .utils import is_metainfo_file
+from .screenshots import ScreenshotFetcher
 
 
 class MetadataExtractor:
@@ -43,6 +41,8 @@ class MetadataExtractor:
         self._export_dir = dcache.media_dir
         self._dcache = dcache
         self.write_to_cache = True
+        # components whose screenshots still need to be fetched
+        self._screenshot_cpts = list()
 
         self._icon_handler = icon_handler
         self._langpacks = langpacks
@@ -52,103 +52,27 @@ class MetadataExtractor:
         self._dcache.reopen()
 
 
-    def _scale_screenshot(self, shot, imgsrc, cpt_export_path, cpt_scr_url):
-        """
-        Scale images in three sets of two-dimensions
-        (752x423 624x351 and 112x63)
-        """
+    @property
+    def icon_handler(self):
+        return self._icon_handler
 
-        name = os.path.basename(imgsrc)
-        sizes = ['1248x702', '752x423', '624x351', '112x63']
-        for size in sizes:
-            wd, ht = size.split('x')
-            img = Image.open(imgsrc)
-            newimg = img.resize((int(wd), int(ht)), Image.ANTIALIAS)
-            newpath = os.path.join(cpt_export_path, size)
-            if not os.path.exists(newpath):
-                os.makedirs(newpath)
-            newimg.save(os.path.join(newpath, name))
-            url = "%s/%s/%s" % (cpt_scr_url, size, name)
-            shot.add_thumbnail(url, width=wd, height=ht)
-
-    def _fetch_screenshots(self, cpt, cpt_export_path, cpt_public_url=""):
-        '''
-        Fetches screenshots from the given url and
-        stores it in png format.
-        '''
 
-        if not cpt.screenshots:
-            # don't ignore metadata if no screenshots are present
-            return True
-
-        success = True
-        shots = list()
-        cnt = 1
-        for shot in cpt.screenshots:
-            # cache some locations which we need later
-            origin_url = shot.source_image['url']
-            if not origin_url:
-                # url empty? skip this screenshot
-                continue
-            path     = cpt.build_media_path(cpt_export_path, "screenshots")
-            base_url = cpt.build_media_path(cpt_public_url,  "screenshots")
-            imgsrc   = os.path.join(path, "source", "scr-%s.png" % (str(cnt)))
-
-            # The Debian services use a custom setup for SSL verification, not trusting global CAs and
-            # only Debian itself. If we are running on such a setup, ensure we load the global CA certs
-            # in order to establish HTTPS connections to foreign services.
-            # For more information, see https://wiki.debian.org/ServicesSSL
-            context = None
-            ca_path = '/etc/ssl/ca-global'
-            if os.path.isdir(ca_path):
-                ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, capath=ca_path)
-            else:
-                ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-
-            try:
-                # FIXME: The context parameter is only supported since Python 3.4.3, which is not
-                # yet widely available, so we can't use it here...
-                #! image = urllib.request.urlopen(origin_url, context=ssl_context).read()
-                image_req = urllib.request.urlopen(origin_url, timeout=30)
-                if image_req.getcode() != 200:
-                    msg = "HTTP status code was %i." % (image_req.getcode())
-                    cpt.add_hint("screenshot-download-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': msg})
-                    success = False
-                    continue
-
-                if not os.path.exists(os.path.dirname(imgsrc)):
-                    os.makedirs(os.path.dirname(imgsrc))
-                f = open(imgsrc, 'wb')
-                f.write(image_req.read())
-                f.close()
-            except Exception as e:
-                cpt.add_hint("screenshot-download-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': str(e)})
-                success = False
-                continue
+    def serialize_components(self, cpts):
+        return self._dcache.serialize_components(cpts)
 
-            try:
-                img = Image.open(imgsrc)
-                wd, ht = img.size
-                shot.set_source_image(os.path.join(base_url, "source", "scr-%s.png" % (str(cnt))), width=wd, height=ht)
-                del img
-            except Exception as e:
-                error_msg = str(e)
-                # filter out the absolute path: we shouldn't add it
-                if error_msg:
-                    error_msg = error_msg.replace(os.path.dirname(imgsrc), "")
-                cpt.add_hint("screenshot-read-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': error_msg})
-                success = False
-                continue
 
-            self._scale_screenshot(shot, imgsrc, path, base_url)
-            shots.append(shot)
-            cnt = cnt + 1
+    def take_screenshot_components(self):
+        '''
+        Returns the components we found since the last call whose screenshots still need to be
+        fetched, as list of (component, export path) tuples.
+        '''
 
-        cpt.screenshots = shots
-        return success
+        cpts = self._screenshot_cpts
+        self._screenshot_cpts = list()
+        return cpts
 
 
-    def _process_pkg(self, pkg, metainfo_files=None):
+    def _process_pkg(self, pkg):
         """
         Reads the metadata from the xml file and the desktop files.
         Returns a list of processed dep11.Component objects.
@@ -162,7 +86,8 @@ class MetadataExtractor:
             return list()
 
         try:
-            filelist = deb.get_filelist()
+            # read the list of files and the data of everything we might need later in one go
+            filelist = deb.scan_interesting()
         except Exception as e:
             log.error("List of files for '%s' could not be read" % (pkg.filename))
             filelist = None
@@ -175,13 +100,26 @@ class MetadataExtractor:
         export_path = "%s/%s" % (self._export_dir, self._archive_component)
         component_dict = dict()
 
-        # if we don't have an explicit list of interesting files, we simply scan all
-        if not metainfo_files:
-            metainfo_files = filelist
+        # fetch the data of all metainfo files, which the scan above has kept already.
+        # We only look at the files the package actually contains, the Contents data might be outdated.
+        wanted_files = [f for f in filelist if is_metainfo_file(f)]
+
+        files_data = dict()
+        extract_error = None
+        if wanted_files:
+            try:
+                files_data = deb.get_files_data(wanted_files)
+            except Exception as e:
+                extract_error = e
+
+        def read_file_data(fname):
+            if extract_error:
+                raise extract_error
+            return str(files_data.get(fname), 'utf-8')
 
         # first cache all additional metadata (.desktop/.pc/etc.) files
         mdata_raw = dict()
-        for meta_file in metainfo_files:
+        for meta_file in filelist:
             if meta_file.endswith(".desktop") and meta_file.startswith("usr/share/applications"):
                 # We have a .desktop file
                 dcontent = None
@@ -189,7 +127,7 @@ class MetadataExtractor:
 
                 error = None
                 try:
-                    dcontent = str(deb.get_file_data(meta_file), 'utf-8')
+                    dcontent = read_file_data(meta_file)
                 except Exception as e:
                     error = {'tag': "deb-extract-error",
                                 'params': {'fname': cpt_id, 'pkg_fname': os.path.basename(pkg.filename), 'error': str(e)}}
@@ -199,13 +137,13 @@ class MetadataExtractor:
                 mdata_raw[cpt_id] = {'error': error, 'data': dcontent}
 
         # process all AppStream XML files
-        for meta_file in metainfo_files:
+        for meta_file in filelist:
             if meta_file.endswith(".xml") and (meta_file.startswith("usr/share/metainfo") or meta_file.startswith("usr/share/appdata")):
                 xml_content = None
                 cpt = Component(self._suite_name, pkg)
 
                 try:
-                    xml_content = str(deb.get_file_data(meta_file), 'utf-8')
+                    xml_content = read_file_data(meta_file)
                 except Exception as e:
                     # inability to read an AppStream XML file is a valid reason to skip the whole package
                     cpt.add_hint("deb-extract-error", {'fname': meta_file, 'pkg_fname': os.path.basename(pkg.filename), 'error': str(e)})
@@ -260,7 +198,8 @@ class MetadataExtractor:
                         pass
 
         # fetch media (icons/screenshots), if we don't ignore the component already
-        cpts = component_dict.values()
+        cpts = list(component_dict.values())
+        media_cpts = list()
         for cpt in cpts:
             if cpt.has_ignore_reason():
                 continue
@@ -287,12 +226,15 @@ class MetadataExtractor:
                     ecpt = yaml.safe_load(existing_mdata)
                     cpt.add_hint("metainfo-duplicate-id", {'cid': cpt.cid, 'pkgname': ecpt.get('Package', '')})
                     continue
+            media_cpts.append(cpt)
 
+        for cpt in media_cpts:
             self._icon_handler.fetch_icon(cpt, pkg, export_path)
             if cpt.kind == 'desktop-app' and not cpt.has_icon():
                 cpt.add_hint("gui-app-without-icon", {'cid': cpt.cid})
-            else:
-                self._fetch_screenshots(cpt, export_path)
+            elif cpt.screenshots:
+                # the screenshots are fetched later, so we don't have to wait for the downloads here
+                self._screenshot_cpts.append((cpt, export_path))
 
             # Since not all software ships a metainfo file yet, we add the package description as metadata to those
             # which don't, to get them to show up in software centers.
@@ -304,13 +246,15 @@ class MetadataExtractor:
 
         return cpts
 
-    def process(self, pkg, metainfo_files=None):
+    def process(self, pkg):
         """
         Reads the metadata from the xml file and the desktop files.
         Returns a list of dep11.Component objects, and writes the result to the cache.
+        If we don't write to the cache, the screenshots of the components still need to be
+        fetched, see take_screenshot_components().
         """
 
-        cpts = self._process_pkg(pkg, metainfo_files)
+        cpts = self._process_pkg(pkg)
 
         # build the package unique identifier (again)
         # NOTE: We could also get this from any returned component (pkid property)
@@ -318,12 +262,17 @@ class MetadataExtractor:
 
         # write data to cache
         if self.write_to_cache:
-            # write the components we found to the cache
-            self._dcache.set_components(pkgid, cpts)
-            self._dcache.add_package_to_suite(pkgid, "%s/%s/%s" % (self._suite_name, self._archive_component, self._arch))
+            http_cache_updates = ScreenshotFetcher(self._dcache).fetch_wait(self.take_screenshot_components())
+            # write the components we found to the cache, in one transaction
+            with self._dcache.batch():
+                self._dcache.set_components(pkgid, cpts)
+                for url, entry in http_cache_updates.items():
+                    self._dcache.set_http_cache_entry(url, entry)
+                self._dcache.add_package_to_suite(pkgid, "%s/%s/%s" % (self._suite_name, self._archive_component, self._arch))
 
         # ensure DebFile is closed so we don't run out of FDs when too many
         # files are open.
         pkg.close()
+        self._icon_handler.close_packages()
 
         return cpts
@@ -18,25 +18,33 @@
 from collections import defaultdict
 import os
 import sys
+import time
 import apt_pkg
 import gzip
 import tarfile
 import glob
+import hashlib
 import traceback
+import threading
+import queue
 from argparse import ArgumentParser
 import multiprocessing as mp
 import logging as log
 from functools import partial
-import yaml
 
 from dep11 import DataCache, MetadataExtractor
 from .component import get_dep11_header
 from .iconhandler import IconHandler
+from .iconcache import IconCache
+from .workerpool import WorkerPool, get_shared
+from .downloader import set_download_deadline, get_downloader
+from .imagepool import set_image_processes, get_image_pool, close_image_pool
+from .screenshots import ScreenshotFetcher
 from .ubuntulangpackhandler import UbuntuLangpackHandler
-from .utils import load_generator_config
-from .package import read_packages_dict_from_file
+from .utils import load_generator_config, get_file_stamp
+from .package import read_packages_dict_from_file, set_package_index_dir, set_translations_dir
 from .reportgenerator import ReportGenerator
-from .contentsfile import parse_contents_file
+from .contentsfile import read_metainfo_files_index
 
 
 def safe_move_file(old_fname, new_fname):
@@ -47,13 +55,265 @@ def safe_move_file(old_fname, new_fname):
     os.rename(old_fname, new_fname)
 
 
-def extract_metadata(mde, sn, pkg):
+# the cache of a worker process, which stays open for the worker's whole lifetime
+_worker_cache = None
+
+def init_worker(cache):
+    global _worker_cache
     # we're now in a new process and can (re)open a LMDB connection
+    _worker_cache = cache
+    _worker_cache.reopen()
+
+
+def extract_metadata(mde_key, sn, pkg):
+    # the extractor is sent to each worker only once and kept there
+    mde = get_shared(mde_key)
+    # this reuses the LMDB environment the worker has opened already.
+    # We only read from the cache here, the results are written by the main process.
     mde.reopen_cache()
+    mde.write_to_cache = False
+
+    stats = mde.icon_handler.icon_cache_stats()
     cpts = mde.process(pkg)
+    stats = tuple(new - old for new, old in zip(mde.icon_handler.icon_cache_stats(), stats))
+
+    # The main process fetches the screenshots, so we don't have to wait for any downloads.
+    # It serializes the components once the screenshots are done.
+    screenshot_cpts = mde.take_screenshot_components()
+    if screenshot_cpts:
+        cpts_data = None
+        screenshots = (cpts, screenshot_cpts)
+    else:
+        cpts_data = mde.serialize_components(cpts)
+        screenshots = None
 
     msgtxt = "Processed ({0}/{1}): %s (%s/%s), found %i" % (pkg.name, sn, pkg.arch, len(cpts))
-    return (msgtxt, all(not x.has_ignore_reason() for x in cpts))
+    return (msgtxt, cpts_data, screenshots, all(not x.has_ignore_reason() for x in cpts), stats)
+
+
+class MetadataExtractionPool:
+    '''
+    Extracts metadata from the new packages of all components and architectures of a suite
+    on one pool of worker processes.
+    The workers only read from the cache and send their results back to us. All results are
+    written by a single thread, which commits them in large batches, so the workers never
+    have to wait for the LMDB writer lock.
+    Screenshots are fetched by this process, in the background, so the workers can go on
+    with the next package right away.
+    '''
+
+    def __init__(self, cache, suite_name, archive_root, processes=None, worker_max_rss=None):
+        self._cache = cache
+        self._suite_name = suite_name
+        self._archive_root = archive_root
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._works = list()
+        self._errors = list()
+
+        # The workers are started by a forkserver which has all our modules loaded already,
+        # and are only replaced if they grow too big.
+        self._pool = WorkerPool(processes, initializer=init_worker, initargs=(cache,),
+                                max_rss=worker_max_rss, preload=['dep11.generator'])
+        self._screenshots = ScreenshotFetcher(cache)
+        self._download_time = get_downloader().busy_time
+        # this starts the image processes, through the forkserver we have just set up
+        self._image_time = get_image_pool().busy_time
+        self._writer = threading.Thread(target=self._write_results, daemon=True)
+        self._writer.start()
+
+
+    def add_jobs(self, component, arch_jobs):
+        '''
+        Queue the packages of all architectures of a component for processing.
+        Returns a handle to wait for the component to be completed.
+        '''
+
+        # Builds of the same package version for different architectures almost always contain
+        # the same metadata, resulting in components with the same global-id.
+        # We process one build first, and all others only after it has been finished, so they
+        # find the component data in the cache and don't need to fetch icons and screenshots again.
+        # Builds with the same package-id (arch:all packages) only need to be processed once at all.
+        primary_tasks = list()
+        sibling_tasks = defaultdict(list)
+        suite_adds = list()
+        first_seen = dict()
+        for job in arch_jobs:
+            if job['mde']:
+                # the extractor of an architecture is only sent once to every worker
+                job['mde_key'] = self._pool.share(job['mde'])
+            for pkid, pkg in job['pkgs_todo'].items():
+                package_fname = os.path.join (self._archive_root, pkg.filename)
+                if not os.path.exists(package_fname):
+                    log.warning('Package not found: %s' % (package_fname))
+                    # we need to look at this architecture again, once the package is there
+                    job['incomplete'] = True
+                    continue
+                pkg.filename = package_fname
+
+                key = (pkg.name, pkg.version)
+                primary = first_seen.get(key)
+                if not primary:
+                    first_seen[key] = (job, pkid)
+                    primary_tasks.append((job, pkid, pkg))
+                elif primary[1] == pkid:
+                    suite_adds.append((job, pkid))
+                else:
+                    sibling_tasks[key].append((job, pkid, pkg))
+
+        task_count = len(primary_tasks) + sum(len(tasks) for tasks in sibling_tasks.values())
+        work = {'component': component,
+                'sibling_tasks': sibling_tasks,
+                'suite_adds': suite_adds,
+                'task_count': task_count,
+                'count': 1,
+                'pending': task_count,
+                'icon_cache_hits': 0,
+                'icon_cache_misses': 0,
+                'done': threading.Event()}
+        with self._lock:
+            self._works.append(work)
+            if self._errors:
+                work['done'].set()
+
+        log.info("Processing %i packages in %s/%s" % (task_count, self._suite_name, component))
+        if task_count == 0:
+            self._finish(work)
+        for job, pkid, pkg in primary_tasks:
+            self._submit(work, job, pkid, pkg, True)
+        return work
+
+
+    def _submit(self, work, job, pkid, pkg, primary):
+        key = (pkg.name, pkg.version) if primary else None
+        # Queued packages are processed largest first, so we don't end up waiting for a few huge
+        # ones (game data, icon themes, ...) with all other workers idle at the end of the run.
+        self._pool.apply_async(extract_metadata,
+                    (job['mde_key'], self._suite_name, pkg),
+                    callback=lambda result: self._handle_result(work, job, pkid, key, result),
+                    error_callback=self._handle_error,
+                    shared=(job['mde_key'],),
+                    priority=pkg.size)
+
+
+    def _handle_result(self, work, job, pkid, key, result):
+        screenshots = result[2]
+        if not screenshots:
+            self._results.put((work, job, pkid, key, result, dict()))
+            return
+
+        # the result is written once all screenshots are here
+        try:
+            self._screenshots.fetch(screenshots[1],
+                    lambda http_cache_updates: self._results.put((work, job, pkid, key, result, http_cache_updates)))
+        except Exception as e:
+            self._handle_error(e)
+
+
+    def _handle_error(self, e):
+        traceback.print_exception(type(e), e, e.__traceback__)
+        if hasattr(e, 'remote_traceback'):
+            print(e.remote_traceback, file=sys.stderr)
+        log.error(str(e))
+        with self._lock:
+            self._errors.append(e)
+            # wake up everyone waiting for results
+            for work in self._works:
+                work['done'].set()
+
+
+    def _finish(self, work):
+        # register packages we have processed for one architecture already with the other ones
+        with self._cache.batch():
+            for job, pkid in work['suite_adds']:
+                if not self._cache.is_ignored(pkid):
+                    self._cache.add_package_to_suite(pkid, job['suite_component_arch'])
+                    job['new_components'] = True
+
+        log.info("Rendered-icon cache for %s/%s: %i hits, %i misses" % (self._suite_name, work['component'], work['icon_cache_hits'], work['icon_cache_misses']))
+        work['done'].set()
+
+
+    def _write_results(self):
+        while True:
+            items = [self._results.get()]
+            if items[0] is None:
+                return
+            while len(items) < 200:
+                try:
+                    items.append(self._results.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in items
+            items = [item for item in items if item]
+
+            try:
+                with self._cache.batch():
+                    for work, job, pkid, key, (message, cpts_data, screenshots, any_components, stats), http_cache_updates in items:
+                        if cpts_data is None:
+                            # the components have been waiting for their screenshots
+                            cpts_data = self._cache.serialize_components(screenshots[0])
+                        self._cache.set_components_data(pkid, cpts_data)
+                        self._cache.add_package_to_suite(pkid, job['suite_component_arch'])
+                        for url, entry in http_cache_updates.items():
+                            self._cache.set_http_cache_entry(url, entry)
+            except Exception as e:
+                self._handle_error(e)
+                return
+
+            try:
+                for work, job, pkid, key, (message, cpts_data, screenshots, any_components, stats), _ in items:
+                    job['new_components'] = job['new_components'] or any_components
+                    hits, misses = stats
+                    work['icon_cache_hits'] += hits
+                    work['icon_cache_misses'] += misses
+                    log.info(message.format(work['count'], work['task_count']))
+                    work['count'] += 1
+                    work['pending'] -= 1
+
+                    # the data is in the cache now, so process the other architectures
+                    if key:
+                        for sjob, spkid, spkg in work['sibling_tasks'].get(key, list()):
+                            self._submit(work, sjob, spkid, spkg, False)
+                    if work['pending'] == 0:
+                        self._finish(work)
+            except Exception as e:
+                self._handle_error(e)
+                return
+
+            if stop:
+                return
+
+
+    def _check_errors(self):
+        if self._errors:
+            self._pool.terminate()
+            sys.exit(5)
+
+
+    def is_done(self, work):
+        self._check_errors()
+        return work['done'].is_set()
+
+
+    def wait(self, work):
+        '''
+        Wait until all packages of a component have been processed.
+        '''
+
+        work['done'].wait()
+        self._check_errors()
+
+
+    def close(self):
+        self._results.put(None)
+        self._writer.join()
+        self._check_errors()
+        self._pool.close()
+        self._pool.join()
+        log.info("Screenshots for %s: spent %.2fs downloading, %.2fs scaling" % (self._suite_name,
+                    get_downloader().busy_time - self._download_time, get_image_pool().busy_time - self._image_time))
+        close_image_pool()
 
 
 class DEP11Generator:
@@ -94,6 +354,32 @@ class DEP11Generator:
         if not os.path.exists(self._langpack_dir):
             os.makedirs(self._langpack_dir)
 
+        # cache of rendered icons, size limit is given in MiB
+        icon_cache_size = conf.get("IconCacheSize", 512)
+        self._icon_cache = IconCache(os.path.join(cache_dir, "icons"), icon_cache_size * 1024 * 1024)
+
+        # keep the parsed package indices between runs, so unchanged ones don't need to be read again
+        if conf.get("CachePackageIndex", False):
+            set_package_index_dir(os.path.join(cache_dir, "packages"))
+        # the translated package descriptions are looked up on disk, instead of being kept in memory
+        set_translations_dir(os.path.join(cache_dir, "translations"))
+
+        # Screenshots are scaled by a few processes of their own, the metadata is extracted
+        # by as many workers as there are CPUs left.
+        cpu_count = os.cpu_count() or 1
+        image_processes = conf.get("ImageProcesses", max(1, cpu_count // 8))
+        set_image_processes(image_processes)
+        self._worker_count = max(1, cpu_count - image_processes)
+
+        # worker processes are replaced when their memory usage exceeds this limit (in MiB)
+        self._worker_max_rss = conf.get("WorkerMaxMemory", 1024) * 1024 * 1024
+
+        # don't download any screenshots anymore after this many seconds, so a slow
+        # upstream site can't hold up the whole run
+        download_time_limit = conf.get("DownloadTimeLimit")
+        if download_time_limit:
+            set_download_deadline(time.time() + download_time_limit)
+
         self._suites_data = conf['Suites']
 
         self._distro_name = conf.get("DistroName")
@@ -126,6 +412,58 @@ class DEP11Generator:
         return read_packages_dict_from_file(self._archive_root, suite, component, arch, with_description=with_desc).values()
 
 
+    def _get_input_stamp(self, suite_name, arch):
+        '''
+        Returns a string which changes whenever any of the archive index files we read to
+        generate the data for the given suite and architecture changes, or the configuration
+        of the suite changes.
+        '''
+
+        suite = self._suites_data[suite_name]
+        suite_names = [suite_name]
+        if suite.get('baseSuite'):
+            suite_names.append(suite['baseSuite'])
+
+        stamp = hashlib.sha1()
+        stamp.update(bytes(repr(sorted(suite.items())), 'utf-8'))
+        stamp.update(bytes(repr((self._icon_sizes, self._dep11_url, self._repo_name)), 'utf-8'))
+
+        fnames = list()
+        for sname in suite_names:
+            dists_dir = os.path.join(self._archive_root, "dists", sname)
+            # the Release file contains the checksums of all index files
+            for release_fname in ("InRelease", "Release"):
+                release_fname = os.path.join(dists_dir, release_fname)
+                if os.path.isfile(release_fname):
+                    with open(release_fname, 'rb') as f:
+                        stamp.update(f.read())
+                    break
+            fnames.extend(glob.glob(os.path.join(dists_dir, "*", "binary-%s" % (arch), "Packages.gz")))
+            fnames.extend(glob.glob(os.path.join(dists_dir, "*", "i18n", "Translation-*.xz")))
+            fnames.extend(glob.glob(os.path.join(dists_dir, "*", "Contents-%s.gz" % (arch))))
+            fnames.extend(glob.glob(os.path.join(dists_dir, "Contents-%s.gz" % (arch))))
+
+        for fname in sorted(fnames):
+            stamp.update(bytes("%s=%s\n" % (fname, get_file_stamp(fname)), 'utf-8'))
+        return stamp.hexdigest()
+
+
+    def _suite_unchanged(self, suite_name, input_stamps):
+        '''
+        Check if the data we generated for a suite the last time is still up to date.
+        '''
+
+        suite = self._suites_data[suite_name]
+        for arch, stamp in input_stamps.items():
+            if self._cache.get_input_stamp("%s/%s" % (suite_name, arch)) != stamp:
+                return False
+            for component in suite['components']:
+                data_fname = os.path.join(self._export_dir, "data", suite_name, component, "Components-%s.yml.gz" % (arch))
+                if not os.path.exists(data_fname):
+                    return False
+        return True
+
+
     def make_icon_tar(self, suitename, component, pkglist):
         '''
          Generate icons-%(size).tar.gz
@@ -167,6 +505,88 @@ class DEP11Generator:
             safe_move_file(tar.name, tar.name.replace(".new", ""))
 
 
+    def _filter_uninteresting_packages(self, suite_name, component, arch, pkgs_todo):
+        '''
+        Mark all packages in 'pkgs_todo' which don't contain any .desktop or metainfo files
+        according to the Contents file as ignored, and drop them from 'pkgs_todo', so we never
+        have to open them.
+        '''
+
+        try:
+            contents_index = read_metainfo_files_index(self._cache, self._archive_root, suite_name, component, arch)
+        except Exception as e:
+            log.warning("Unable to read Contents data for %s/%s/%s, looking at all packages: %s" % (suite_name, component, arch, str(e)))
+            return
+
+        ignored_count = 0
+        with self._cache.batch():
+            for pkid in list(pkgs_todo.keys()):
+                files = contents_index.get(pkid)
+                if files is None or files:
+                    # the package has interesting files, or isn't listed in the Contents file, so we need to look at it
+                    continue
+                self._cache.set_package_ignore(pkid)
+                del pkgs_todo[pkid]
+                ignored_count += 1
+
+        log.info("Ignored %i packages without metadata in %s/%s/%s based on Contents data." % (ignored_count, suite_name, component, arch))
+
+
+    def _export_arch_data(self, suite_name, component, arch, pkglist, new_components, dep11_header):
+        '''
+        Write the Components and hints files for the given suite/component/arch.
+        '''
+
+        suite_component_arch = "%s/%s/%s" % (suite_name, component, arch)
+        dep11_dir = os.path.join(self._export_dir, "data", suite_name, component)
+        data_fname = os.path.join(dep11_dir, "Components-%s.yml.gz" % (arch))
+
+        hints_dir = os.path.join(self._export_dir, "hints", suite_name, component)
+        if not os.path.exists(hints_dir):
+            os.makedirs(hints_dir)
+        hints_fname = os.path.join(hints_dir, "DEP11Hints_%s.yml.gz" % (arch))
+        hints_f = gzip.open(hints_fname+".new", 'wb')
+
+        if not new_components and os.path.exists(data_fname):
+            log.info("Skipping %s, no components in any of the new packages.", suite_component_arch)
+        else:
+            # now write data to disk
+            data_f = gzip.open(data_fname+".new", 'wb')
+
+            data_f.write(bytes(dep11_header, 'utf-8'))
+
+        for pkg in pkglist:
+            pkid = pkg.pkid
+            if new_components:
+                data = self._cache.get_metadata_for_pkg(pkid)
+                if data:
+                    data_f.write(bytes(data, 'utf-8'))
+            hint = self._cache.get_hints(pkid)
+            if hint:
+                hints_f.write(bytes(hint, 'utf-8'))
+
+        if new_components:
+            data_f.close()
+            safe_move_file(data_fname+".new", data_fname)
+
+        hints_f.close()
+        safe_move_file(hints_fname+".new", hints_fname)
+
+
+    def _export_component(self, suite_name, component, arch_jobs, all_cpt_pkgs, dep11_header):
+        '''
+        Write the data of all architectures of a component, after all its packages have been processed.
+        '''
+
+        for job in arch_jobs:
+            self._export_arch_data(suite_name, component, job['arch'], job['pkglist'], job['new_components'], dep11_header)
+
+        # create icon tarball
+        self.make_icon_tar(suite_name, component, all_cpt_pkgs)
+
+        log.info("Completed metadata extraction for suite %s/%s" % (suite_name, component))
+
+
     def process_suite(self, suite_name):
         '''
         Extract new metadata for a given suite.
@@ -180,6 +600,14 @@ class DEP11Generator:
 
         base_suite = self._suites_data.get(base_suite_name) if base_suite_name else None
 
+        # don't look at anything if the archive didn't change since our last run
+        input_stamps = dict()
+        for arch in suite['architectures']:
+            input_stamps[arch] = self._get_input_stamp(suite_name, arch)
+        if self._suite_unchanged(suite_name, input_stamps):
+            log.info("Skipped suite %s, the archive data has not changed since the last run." % (suite_name))
+            return True
+
         # We need 'forkserver' as startup method to prevent deadlocks on join()
         # Something in the extractor is doing weird things, makes joining impossible
         # when using simple fork as startup method.
@@ -198,50 +626,60 @@ class DEP11Generator:
 
         langpacks = None
 
+        # All components and architectures share one pool of workers, so we can prepare and
+        # export the data of one component while the packages of another one are processed.
+        extraction = None
+        pending_exports = list()
+        suite_jobs = list()
+
         for component in suite['components']:
             all_cpt_pkgs = list()
-            new_components = False
+            dep11_header = get_dep11_header(self._repo_name, suite_name, component, os.path.join(self._dep11_url, component), suite.get('dataPriority', 0))
+            dep11_dir = os.path.join(self._export_dir, "data", suite_name, component)
+            if not os.path.exists(dep11_dir):
+                os.makedirs(dep11_dir)
+
+            # collect the work for all architectures first, so we can process them together
+            arch_jobs = list()
             for arch in suite['architectures']:
                 pkglist = self._all_pkgs[suite_name][component][arch]
                 suite_component_arch = "%s/%s/%s" % (suite_name, component, arch)
-
-                dep11_dir = os.path.join(self._export_dir, "data", suite_name, component)
                 data_fname = os.path.join(dep11_dir, "Components-%s.yml.gz" % (arch))
+                new_components = False
 
-                last_seen_pkgs = set()
-                try:
-                    for y in yaml.load_all(gzip.open(data_fname, 'r')):
-                        if 'Package' in y:
-                            last_seen_pkgs.add(y['Package'])
-                except FileNotFoundError:
-                    pass
+                all_cpt_pkgs.extend(pkglist)
+
+                # the packages we have seen in this suite the last time
+                last_seen_pkgs = self._cache.get_suite_packages(suite_component_arch)
 
                 # compile a list of packages that we need to look into
                 pkgs_todo = dict()
-                for pkg in pkglist:
-                    pkid = pkg.pkid
+                with self._cache.batch():
+                    for pkg in pkglist:
+                        pkid = pkg.pkid
 
-                    last_seen_pkgs.discard(pkg.name)
+                        last_seen_pkgs.discard(pkid)
 
-                    # check if we scanned the package already
-                    if self._cache.package_exists(pkid):
-                        if not self._cache.package_in_suite(pkid, suite_component_arch) and not self._cache.is_ignored(pkid):
-                            log.info("Seen %s before, but not in %s" % (pkid, suite_component_arch))
-                            self._cache.add_package_to_suite(pkid, suite_component_arch)
-                            new_components = True
-                        continue
-                    pkgs_todo[pkid] = pkg
+                        # check if we scanned the package already
+                        if self._cache.package_exists(pkid):
+                            if not self._cache.package_in_suite(pkid, suite_component_arch) and not self._cache.is_ignored(pkid):
+                                log.info("Seen %s before, but not in %s" % (pkid, suite_component_arch))
+                                self._cache.add_package_to_suite(pkid, suite_component_arch)
+                                new_components = True
+                            continue
+                        pkgs_todo[pkid] = pkg
+
+                # don't even open packages which can't contain any metadata
+                if pkgs_todo:
+                    self._filter_uninteresting_packages(suite_name, component, arch, pkgs_todo)
 
                 # some packages have been removed
                 if last_seen_pkgs:
-                    for pkg in last_seen_pkgs:
-                        self._cache.remove_package_from_suite(pkid, suite_component_arch)
-                    new_components = True
-
-                dep11_header = get_dep11_header(self._repo_name, suite_name, component, os.path.join(self._dep11_url, component), suite.get('dataPriority', 0))
-
-                if not os.path.exists(dep11_dir):
-                    os.makedirs(dep11_dir)
+                    with self._cache.batch():
+                        for pkid in last_seen_pkgs:
+                            self._cache.remove_package_from_suite(pkid, suite_component_arch)
+                            if not self._cache.is_ignored(pkid):
+                                new_components = True
 
                 if not pkgs_todo and not new_components:
                     if not os.path.exists(data_fname):
@@ -253,98 +691,71 @@ class DEP11Generator:
                         log.info("Skipped %s, no new packages to process." % suite_component_arch)
                     continue
 
+                job = {'arch': arch,
+                       'suite_component_arch': suite_component_arch,
+                       'pkglist': pkglist,
+                       'pkgs_todo': pkgs_todo,
+                       'new_components': new_components,
+                       'incomplete': False,
+                       'mde': None}
+                arch_jobs.append(job)
+
                 if pkgs_todo:
                     # set up metadata extractor
                     icon_theme = suite.get('useIconTheme')
-                    iconh = IconHandler(suite_name, component, arch, self._archive_root,
-                                                   icon_theme, base_suite_name=suite.get('baseSuite'))
+                    iconh = IconHandler(suite_name, component, arch, self._archive_root, self._cache,
+                                                   icon_theme, base_suite_name=suite.get('baseSuite'),
+                                                   icon_cache=self._icon_cache)
                     iconh.set_wanted_icon_sizes(self._icon_sizes)
+                    # icons might be shipped in dependencies from the same component, 'main' or the base suite
+                    depends_pkglists = [pkglist, self._all_pkgs[suite_name]['main'][arch]]
+                    if base_suite_name:
+                        depends_pkglists.append(self._all_pkgs[base_suite_name]['main'][arch])
+                    iconh.set_packages(depends_pkglists)
                     if not langpacks:
                         langpacks = UbuntuLangpackHandler(suite, suite_name, self._all_pkgs, self._langpack_dir, self._cache)
-                    mde = MetadataExtractor(suite_name,
+                    job['mde'] = MetadataExtractor(suite_name,
                                     component,
                                     arch,
                                     self._cache,
                                     iconh,
                                     langpacks)
 
-                    # Multiprocessing can't cope with LMDB open in the cache,
-                    # but instead of throwing an error or doing something else
-                    # that makes debugging easier, it just silently skips each
-                    # multprocessing task. Stupid thing.
-                    # (remember to re-open the cache later)
-                    self._cache.close()
-
-                    # set up multiprocessing
-                    with mp.Pool(maxtasksperchild=24) as pool:
-                        count = 1
-                        def handle_results(result):
-                            nonlocal count
-                            nonlocal new_components
-                            (message, any_components) = result
-                            new_components = new_components or any_components
-                            log.info(message.format(count, len(pkgs_todo)))
-                            count += 1
-
-                        def handle_error(e):
-                            traceback.print_exception(type(e), e, e.__traceback__)
-                            log.error(str(e))
-                            pool.terminate()
-                            sys.exit(5)
-
-                        log.info("Processing %i packages in %s" % (len(pkgs_todo), suite_component_arch))
-                        for pkid, pkg in pkgs_todo.items():
-                            package_fname = os.path.join (self._archive_root, pkg.filename)
-                            if not os.path.exists(package_fname):
-                                log.warning('Package not found: %s' % (package_fname))
-                                continue
-                            pkg.filename = package_fname
-                            pool.apply_async(extract_metadata,
-                                        (mde, suite_name, pkg),
-                                        callback=handle_results, error_callback=handle_error)
-                        pool.close()
-                        pool.join()
-
-                    # reopen the cache, we need it
-                    self._cache.reopen()
-
-                hints_dir = os.path.join(self._export_dir, "hints", suite_name, component)
-                if not os.path.exists(hints_dir):
-                    os.makedirs(hints_dir)
-                hints_fname = os.path.join(hints_dir, "DEP11Hints_%s.yml.gz" % (arch))
-                hints_f = gzip.open(hints_fname+".new", 'wb')
-
-                if not new_components and os.path.exists(data_fname):
-                    log.info("Skipping %s, no components in any of the new packages.", suite_component_arch)
-                else:
-                    # now write data to disk
-                    data_f = gzip.open(data_fname+".new", 'wb')
-
-                    data_f.write(bytes(dep11_header, 'utf-8'))
-
-                for pkg in pkglist:
-                    pkid = pkg.pkid
-                    if new_components:
-                        data = self._cache.get_metadata_for_pkg(pkid)
-                        if data:
-                            data_f.write(bytes(data, 'utf-8'))
-                    hint = self._cache.get_hints(pkid)
-                    if hint:
-                        hints_f.write(bytes(hint, 'utf-8'))
-
-                if new_components:
-                    data_f.close()
-                    safe_move_file(data_fname+".new", data_fname)
-
-                hints_f.close()
-                safe_move_file(hints_fname+".new", hints_fname)
-
-                all_cpt_pkgs.extend(pkglist)
-
-            # create icon tarball
-            self.make_icon_tar(suite_name, component, all_cpt_pkgs)
+            work = None
+            if any(job['pkgs_todo'] for job in arch_jobs):
+                if not extraction:
+                    extraction = MetadataExtractionPool(self._cache, suite_name, self._archive_root,
+                                                        self._worker_count, self._worker_max_rss)
+                work = extraction.add_jobs(component, arch_jobs)
+            pending_exports.append((component, arch_jobs, all_cpt_pkgs, dep11_header, work))
+            suite_jobs.extend(arch_jobs)
+
+            # write the data of the components which have been completed in the meantime,
+            # while the workers are busy with the ones we just added
+            for export in list(pending_exports):
+                work = export[-1]
+                if not work or extraction.is_done(work):
+                    self._export_component(suite_name, *export[:-1])
+                    pending_exports.remove(export)
+
+        for export in pending_exports:
+            extraction.wait(export[-1])
+            self._export_component(suite_name, *export[:-1])
+        if extraction:
+            extraction.close()
+
+        # remember what our data was generated from, so we can skip the next run if nothing changes.
+        # Architectures with packages we could not process must not be skipped, so they are retried.
+        incomplete_archs = set(job['arch'] for job in suite_jobs if job['incomplete'])
+        with self._cache.batch():
+            for arch, stamp in input_stamps.items():
+                if arch in incomplete_archs:
+                    log.info("Not all packages of %s/%s could be processed, it will be checked again on the next run." % (suite_name, arch))
+                    continue
+                self._cache.set_input_stamp("%s/%s" % (suite_name, arch), stamp)
 
-            log.info("Completed metadata extraction for suite %s/%s" % (suite_name, component))
+        # keep the rendered-icon cache in bounds
+        self._icon_cache.expire()
 
 
     def expire_cache(self):
@@ -359,14 +770,19 @@ class DEP11Generator:
 
         # clean cache
         oldpkgs = self._cache.get_packages_not_in_set(pkgids)
-        for pkid in oldpkgs:
-            pkid = str(pkid, 'utf-8')
-            self._cache.remove_package(pkid)
+        with self._cache.batch():
+            for pkid in oldpkgs:
+                pkid = str(pkid, 'utf-8')
+                self._cache.remove_package(pkid)
 
         # ensure we don't leave cruft, drop orphaned components (cpts w/o pkg)
         self._cache.remove_orphaned_components()
         # drop orphaned media (media w/o registered cpt)
         self._cache.remove_orphaned_media()
+        # forget about screenshots we don't have anymore
+        self._cache.remove_orphaned_http_cache_entries()
+        # drop least recently used rendered icons
+        self._icon_cache.expire()
 
 
     def remove_processed(self, suite_name):
@@ -383,21 +799,25 @@ class DEP11Generator:
             for arch in suite['architectures']:
                 pkglist = self._get_packages_for(suite_name, component, arch, with_desc=False)
 
-                for pkg in pkglist:
-                    pkid = pkg.pkid
+                with self._cache.batch():
+                    for pkg in pkglist:
+                        pkid = pkg.pkid
 
-                    # we ignore packages without any interesting metadata here
-                    if self._cache.is_ignored(pkid):
-                        continue
-                    if not self._cache.package_exists(pkid):
-                        continue
+                        # we ignore packages without any interesting metadata here
+                        if self._cache.is_ignored(pkid):
+                            continue
+                        if not self._cache.package_exists(pkid):
+                            continue
 
-                    self._cache.remove_package(pkid)
+                        self._cache.remove_package(pkid)
 
         # drop all components which don't have packages
         self._cache.remove_orphaned_components()
         self._cache.remove_orphaned_media()
 
+        # ensure the suite gets processed again, even if the archive doesn't change
+        self._cache.clear_input_stamps(suite_name + "/")
+
 
     def forget_package(self, pkid):
         '''
@@ -419,6 +839,9 @@ class DEP11Generator:
         # drop all components which don't have packages
         self._cache.remove_orphaned_components()
 
+        # the package needs to be reprocessed in the next run
+        self._cache.clear_input_stamps()
+
 
     def show_info(self, pkgname):
         '''
@@ -445,35 +868,20 @@ class DEP11Generator:
 
         for component in suite['components']:
             for arch in suite['architectures']:
-                pkid_filelist = dict()
-                for fname, pkg in parse_contents_file(self._archive_root, suite_name, component, arch):
-                    if not pkid_filelist.get(pkg.pkid):
-                        pkid_filelist[pkg.pkid] = list()
-                    pkid_filelist[pkg.pkid].append(fname)
-
-                for pkid, filelist in pkid_filelist.items():
-                    ignore = True
-                    for f in filelist:
-                        if 'usr/share/applications/' in f:
-                            ignore = False
-                            break
-                        if 'usr/share/metainfo/' in f:
-                            ignore = False
-                            break
-                        if 'usr/share/appdata/' in f:
-                            ignore = False
-                            break
-
-                    if not ignore:
-                        continue
-
-                    if self._cache.is_ignored(pkid):
-                        log.info("Package is already ignored: {}".format(pkid))
-                    elif self._cache.package_exists(pkid):
-                        log.warning("Tried to ignore package which actually exists and has data: {}".format(pkid))
-                    else:
-                        log.info("Ignoring package: {}".format(pkid))
-                        self._cache.set_package_ignore(pkid)
+                contents_index = read_metainfo_files_index(self._cache, self._archive_root, suite_name, component, arch)
+
+                with self._cache.batch():
+                    for pkid, metainfo_files in contents_index.items():
+                        if metainfo_files:
+                            continue
+
+                        if self._cache.is_ignored(pkid):
+                            log.info("Package is already ignored: {}".format(pkid))
+                        elif self._cache.package_exists(pkid):
+                            log.warning("Tried to ignore package which actually exists and has data: {}".format(pkid))
+                        else:
+                            log.info("Ignoring package: {}".format(pkid))
+                            self._cache.set_package_ignore(pkid)
 
 
 def main():
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import time
+import hashlib
+import logging as log
+
+from .utils import link_or_copy
+
+
+class IconCache:
+    '''
+    A content-addressed cache of rendered icons.
+    Icons are keyed by the checksum of their source data, their size and their format, so
+    the same icon is only rendered once, even if it is used by many components (e.g. a stock
+    icon from a theme) or shipped in the builds of a package for multiple architectures.
+    '''
+
+    def __init__(self, cache_dir, max_size=None):
+        self._dir = cache_dir
+        self._max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir, exist_ok=True)
+
+
+    def store(self, icon_data, size, dest, render):
+        '''
+        Place the icon rendered from 'icon_data' with size 'size' at 'dest'.
+        If we don't have a matching icon in the cache yet, 'render' is called with
+        the filename the rendered icon should be written to.
+        '''
+
+        fmt = os.path.splitext(dest)[1]
+        data_hash = hashlib.sha256(icon_data).hexdigest()
+        cache_fname = os.path.join(self._dir, data_hash[:2], "%s_%s%s" % (data_hash, str(size), fmt))
+
+        if os.path.exists(cache_fname):
+            self.hits += 1
+            # mark the cache entry as recently used. We only touch the access time, since
+            # the modification time is shared with all hardlinks in the media directory.
+            try:
+                st = os.stat(cache_fname)
+                os.utime(cache_fname, (time.time(), st.st_mtime))
+            except OSError:
+                pass
+        else:
+            self.misses += 1
+            os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+
+            # render to a temporary file first, so other processes never see partial data
+            base, ext = os.path.splitext(cache_fname)
+            tmp_fname = "%s.%i.tmp%s" % (base, os.getpid(), ext)
+            try:
+                render(tmp_fname)
+                os.replace(tmp_fname, cache_fname)
+            finally:
+                if os.path.exists(tmp_fname):
+                    os.remove(tmp_fname)
+
+        link_or_copy(cache_fname, dest)
+
+
+    def expire(self):
+        '''
+        Drop the least recently used icons from the cache, until its size is below
+        the configured maximum size.
+        '''
+
+        entries = list()
+        total_size = 0
+        now = time.time()
+        for dirpath, dirs, files in os.walk(self._dir):
+            for fname in files:
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if '.tmp' in fname:
+                    # leftovers of a crashed process
+                    if now - st.st_mtime > 3600:
+                        os.remove(path)
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+                total_size += st.st_size
+
+        if not self._max_size or total_size <= self._max_size:
+            return
+
+        # evict until we are comfortably below the limit again
+        target_size = self._max_size * 0.9
+        removed = 0
+        entries.sort()
+        for atime, size, path in entries:
+            if total_size <= target_size:
+                break
+            os.remove(path)
+            total_size -= size
+            removed += 1
+
+        log.info("Removed %i icons from the rendered-icon cache." % (removed))
@@ -17,6 +17,7 @@
 
 import os
 import gzip
+from collections import deque
 import logging as log
 
 import zlib
@@ -30,7 +31,9 @@ from io import StringIO, BytesIO
 
 from .component import IconSize, IconType
 from .debfile import DebFile
-from .contentsfile import parse_contents_file
+from .package import Package
+from .contentsfile import update_contents_index
+from .utils import is_icon_file, is_image_file
 
 
 class Theme:
@@ -89,12 +92,18 @@ class IconHandler:
     to find icons not already present in the package file itself.
     '''
 
-    def __init__(self, suite_name, archive_component, arch_name, archive_mirror_dir, icon_theme=None, base_suite_name=None):
+    def __init__(self, suite_name, archive_component, arch_name, archive_mirror_dir, cache, icon_theme=None, base_suite_name=None, icon_cache=None):
         self._component = archive_component
         self._mirror_dir = archive_mirror_dir
+        self._cache = cache
+        self._icon_cache = icon_cache
 
         self._themes = list()
-        self._icon_files = dict()
+        # keys of the Contents indices in the cache we search for icons, data loaded later takes precedence
+        self._contents_keys = list()
+        self._icon_pkgs = dict()
+        # package name -> names of its dependencies
+        self._depends = dict()
 
         self._wanted_icon_sizes = [IconSize(64), IconSize(128)],
 
@@ -131,25 +140,137 @@ class IconHandler:
             log.info("Removing theme '%s' from seeded theme-names: Theme not found." % (theme))
 
 
+    def icon_cache_stats(self):
+        '''
+        Returns the number of hits and misses of the rendered-icon cache.
+        '''
+        if not self._icon_cache:
+            return 0, 0
+        return self._icon_cache.hits, self._icon_cache.misses
+
+
     def set_wanted_icon_sizes(self, icon_size_strv):
         self._wanted_icon_sizes = list()
         for strsize in icon_size_strv:
             self._wanted_icon_sizes.append(IconSize(strsize))
 
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # don't send packages with possibly open .deb files to other processes
+        state['_icon_pkgs'] = dict()
+        return state
+
+
     def _load_contents_data(self, arch_name, suite_name, component):
-        # load and preprocess the large file.
-        # we don't show mercy to memory here, we just want the icon lookup to be fast,
-        # so we need to cache the data.
-        for fname, pkg in parse_contents_file(self._mirror_dir, suite_name, component, arch_name):
-            if fname.startswith('usr/share/pixmaps/'):
-                self._icon_files[fname] = pkg
+        # the Contents file is large, so we only parse it when it has changed and
+        # look up icons in the index stored in our cache.
+        key = update_contents_index(self._cache, self._mirror_dir, suite_name, component, arch_name)
+        self._contents_keys.append(key)
+
+        for name in self._theme_names:
+            pkg = self._get_contents_pkg(key, 'usr/share/icons/{}/index.theme'.format(name))
+            if pkg:
+                self._themes.append(Theme(name, pkg.filename))
+
+
+    def set_packages(self, pkglists):
+        '''
+        Learn the dependencies of the packages in all lists of 'pkglists'. We follow them
+        to find icons which are referenced by absolute path, but shipped in another package.
+        '''
+
+        for pkglist in pkglists:
+            for pkg in pkglist:
+                self._depends[pkg.name] = pkg.depends_names
+
+
+    def _get_contents_pkg(self, key, fname):
+        '''
+        Returns the package containing 'fname' according to the Contents index 'key'.
+        '''
+
+        pkgnames = self._cache.find_contents_index_file(key, fname)
+        if not pkgnames:
+            return None
+        return self._get_contents_index_pkg(key, pkgnames[-1])
+
+
+    def _get_contents_index_pkg(self, key, pkgname):
+        '''
+        Returns the package 'pkgname' from the Contents index 'key'.
+        '''
+
+        pkg = self._icon_pkgs.get((key, pkgname))
+        if pkg:
+            return pkg
+        info = self._cache.get_contents_index_package(key, pkgname)
+        if not info:
+            return None
+        version, arch, pkg_fname = info
+        pkg = Package(pkgname, version, arch, pkg_fname)
+        self._icon_pkgs[(key, pkgname)] = pkg
+        return pkg
+
+
+    def close_packages(self):
+        '''
+        Close all packages we opened to look for icons.
+        '''
+
+        for pkg in self._icon_pkgs.values():
+            pkg.close()
+        self._icon_pkgs = dict()
+
+
+    def _find_depends_with_file(self, pkg, fname):
+        '''
+        Returns the nearest dependency of 'pkg' which contains 'fname'.
+        If the file is in the Contents indices, we only need to walk the dependencies by name.
+        Other files can only be found by looking into the .deb files, which we only do
+        for the direct dependencies.
+        '''
+
+        owners = None
+        if is_icon_file(fname) or is_image_file(fname):
+            owners = set()
+            for key in self._contents_keys:
+                owners.update(self._cache.find_contents_index_file(key, fname) or list())
+            if not owners:
+                return None
+
+        seen = set([pkg.name])
+        queue = deque(pkg.depends_names)
+        while queue:
+            name = queue.popleft()
+            if name in seen:
                 continue
-            for name in self._theme_names:
-                if fname == 'usr/share/icons/{}/index.theme'.format(name):
-                    self._themes.append(Theme(name, pkg.filename))
-                elif fname.startswith('usr/share/icons/{}'.format(name)):
-                    self._icon_files[fname] = pkg
+            seen.add(name)
+
+            if owners is None or name in owners:
+                for key in reversed(self._contents_keys):
+                    dep = self._get_contents_index_pkg(key, name)
+                    if not dep:
+                        continue
+                    if owners is not None or fname in dep.debfile.get_filelist():
+                        return dep
+                    break
+            if owners is not None:
+                queue.extend(self._depends.get(name, list()))
+
+        return None
+
+
+    def _get_icon_pkg(self, fname):
+        '''
+        Returns the package containing the icon 'fname'.
+        '''
+
+        for key in reversed(self._contents_keys):
+            pkg = self._get_contents_pkg(key, fname)
+            if pkg:
+                return pkg
+        return None
 
 
     def _possible_icon_filenames(self, icon, size):
@@ -178,7 +299,7 @@ class IconHandler:
                         break
                 else:
                     # global search
-                    pkg = self._icon_files.get(fname)
+                    pkg = self._get_icon_pkg(fname)
                     if pkg:
                         size_map_flist[size] = { 'icon_fname': fname, 'pkg': pkg }
                         break
@@ -205,21 +326,9 @@ class IconHandler:
             if icon_str[1:] in pkg.debfile.get_filelist():
                 return self._store_icon(pkg, cpt, cpt_export_path, icon_str[1:], IconSize(64))
             else:
-                def search_depends(pkg, seen_packages=list()):
-                    seen_packages.append(pkg.name)
-                    # look through the first level of dependencies
-                    for dep in pkg.depends:
-                        if icon_str[1:] in dep.debfile.get_filelist():
-                            return self._store_icon(dep, cpt, cpt_export_path, icon_str[1:], IconSize(64))
-
-                    # then the rest
-                    for dep in pkg.depends:
-                        if dep.name not in seen_packages and search_depends(dep, seen_packages):
-                            return True
-
-                    return False
-
-                if search_depends(pkg):
+                # the icon might be shipped in a package this one depends on
+                dep = self._find_depends_with_file(pkg, icon_str[1:])
+                if dep and self._store_icon(dep, cpt, cpt_export_path, icon_str[1:], IconSize(64)):
                     return True
         else:
             icon_str = os.path.basename(icon_str)
@@ -234,7 +343,9 @@ class IconHandler:
                 if not icon_dict:
                     return False, None
 
-                icon_stored = False
+                # select the icons we want to store first, so we can extract all of them
+                # from their packages in one go
+                selected = list()
                 last_icon_name = None
                 for size in self._wanted_icon_sizes:
                     info = icon_dict.get(size)
@@ -252,11 +363,7 @@ class IconHandler:
 
                     last_icon_name = info['icon_fname']
                     if self._icon_allowed(last_icon_name):
-                        icon_stored = self._store_icon(info['pkg'],
-                                                cpt,
-                                                cpt_export_path,
-                                                last_icon_name,
-                                                size) or icon_stored
+                        selected.append((size, info))
                     else:
                         # the found icon is not suitable, but maybe a larger one is available that we can downscale?
                         for asize, data in icon_dict.items():
@@ -265,13 +372,19 @@ class IconHandler:
                             info = data
                             break
                         if self._icon_allowed(info['icon_fname']):
-                            icon_stored = self._store_icon(info['pkg'],
-                                                cpt,
-                                                cpt_export_path,
-                                                info['icon_fname'],
-                                                size) or icon_stored
+                            selected.append((size, info))
                             last_icon_name = info['icon_fname']
 
+                load_data = self._icon_data_loader([info for size, info in selected])
+                icon_stored = False
+                for size, info in selected:
+                    icon_stored = self._store_icon(info['pkg'],
+                                            cpt,
+                                            cpt_export_path,
+                                            info['icon_fname'],
+                                            size,
+                                            load_data) or icon_stored
+
                 return icon_stored, last_icon_name
 
 
@@ -296,6 +409,28 @@ class IconHandler:
         return True
 
 
+    def _icon_data_loader(self, icon_infos):
+        '''
+        Returns a function to load icon data from packages. The first time an icon is
+        requested from a package, all icons in 'icon_infos' residing in the same package
+        are extracted together, so each package payload is only read once.
+        '''
+        pkg_icons = dict()
+        for info in icon_infos:
+            pkg_icons.setdefault(info['pkg'].filename, set()).add(info['icon_fname'])
+
+        icons_data = dict()
+        def load_data(pkg, icon_path):
+            key = (pkg.filename, icon_path)
+            if key not in icons_data:
+                fnames = pkg_icons.get(pkg.filename, set()) | set([icon_path])
+                for fname, data in pkg.debfile.get_files_data(fnames).items():
+                    icons_data[(pkg.filename, fname)] = data
+            return icons_data[key]
+
+        return load_data
+
+
     def _icon_allowed(self, icon):
         '''
         Check if the icon is an icon we actually can and want to handle.
@@ -325,11 +460,12 @@ class IconHandler:
         img.write_to_png(store_path)
 
 
-    def _store_icon(self, pkg, cpt, cpt_export_path, icon_path, size):
+    def _store_icon(self, pkg, cpt, cpt_export_path, icon_path, size, load_data=None):
         '''
         Extracts the icon from the deb package and stores it in the cache.
         Ensures the stored icon always has the size given in "size", and renders
         vectorgraphics if necessary.
+        If "load_data" is set, it is used to retrieve the icon data from the package.
         '''
 
         # don't store an icon if we are already ignoring this component
@@ -362,8 +498,10 @@ class IconHandler:
         # eg amarok's icon is in amarok-data
         icon_data = None
         try:
-            deb = pkg.debfile
-            icon_data = deb.get_file_data(icon_path)
+            if load_data:
+                icon_data = load_data(pkg, icon_path)
+            else:
+                icon_data = pkg.debfile.get_file_data(icon_path)
         except Exception as e:
             cpt.add_hint("deb-extract-error", {'fname': icon_name, 'pkg_fname': os.path.basename(pkg.filename), 'error': str(e)})
             return False
@@ -394,21 +532,26 @@ class IconHandler:
 
         if svgicon:
             # render the SVG to a bitmap
-            self._render_svg_to_png(icon_data, icon_store_location, int(size), int(size))
-            return True
+            def render(fname):
+                self._render_svg_to_png(icon_data, fname, int(size), int(size))
         else:
             # we don't trust upstream to have the right icon size present, and therefore
             # always adjust the icon to the right size
-            stream = BytesIO(icon_data)
-            stream.seek(0)
-            img = None
-            try:
+            def render(fname):
+                stream = BytesIO(icon_data)
+                stream.seek(0)
                 img = Image.open(stream)
-            except Exception as e:
-                cpt.add_hint("icon-open-failed", {'icon_fname': icon_name, 'error': str(e)})
-                return False
-            newimg = img.resize((int(size), int(size)), Image.ANTIALIAS)
-            newimg.save(icon_store_location)
-            return True
+                newimg = img.resize((int(size), int(size)), Image.ANTIALIAS)
+                newimg.save(fname)
 
-        return False
+        try:
+            if self._icon_cache:
+                # don't render the same icon twice
+                self._icon_cache.store(bytes(icon_data), size, icon_store_location, render)
+            else:
+                render(icon_store_location)
+        except Exception as e:
+            cpt.add_hint("icon-open-failed", {'icon_fname': icon_name, 'error': str(e)})
+            return False
+
+        return True
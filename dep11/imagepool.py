@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import time
+import threading
+from concurrent.futures import Future
+
+from .workerpool import WorkerPool
+
+
+def _run_timed(func, args):
+    start = time.time()
+    result = func(*args)
+    return (time.time() - start, result)
+
+
+class ImagePool:
+    '''
+    Scales and encodes images in a few processes of their own, so this CPU-bound work
+    neither waits for nor blocks the downloads and the rest of the metadata extraction.
+    At most 'max_pending' images may wait for processing, whoever adds more is blocked
+    until there is room again. For images fed by the downloader, this means that no more
+    downloads finish while the image processes are lagging behind.
+    '''
+
+    def __init__(self, processes=1, max_pending=8):
+        self.processes = processes
+        self._pool = WorkerPool(processes)
+        self._slots = threading.BoundedSemaphore(processes + max_pending)
+        self._lock = threading.Lock()
+
+        # seconds spent processing images
+        self.busy_time = 0
+
+
+    def submit(self, func, *args):
+        '''
+        Run 'func' with 'args' in an image process, returns a future of its result.
+        'func' and 'args' must be picklable.
+        Blocks while too many images are waiting for processing.
+        '''
+
+        future = Future()
+
+        def done(result):
+            with self._lock:
+                self.busy_time += result[0]
+            self._slots.release()
+            future.set_result(result[1])
+
+        def failed(e):
+            self._slots.release()
+            future.set_exception(e)
+
+        self._slots.acquire()
+        try:
+            self._pool.apply_async(_run_timed, (func, args), callback=done, error_callback=failed)
+        except:
+            self._slots.release()
+            raise
+        return future
+
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+# the image pool used by everything in this process
+_image_pool = None
+_image_pool_lock = threading.Lock()
+_image_processes = 1
+
+def set_image_processes(processes):
+    '''
+    Set the number of processes of the image pool returned by get_image_pool().
+    '''
+
+    global _image_processes
+    _image_processes = processes
+
+
+def get_image_pool():
+    '''
+    Returns the image pool shared by everything in this process.
+    '''
+
+    global _image_pool
+    with _image_pool_lock:
+        if not _image_pool:
+            _image_pool = ImagePool(_image_processes)
+        return _image_pool
+
+
+def close_image_pool():
+    '''
+    Wait for all images to be processed and stop the image pool of this process.
+    get_image_pool() starts a new one, if it is needed again.
+    '''
+
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool:
+            _image_pool.close()
+            _image_pool = None
@@ -16,19 +16,31 @@
 # License along with this program.
 
 import os
+import sys
 import glob
 import gzip
 import lzma
 import re
+import atexit
+import shutil
+import pickle
+import hashlib
 import tempfile
+import lmdb
 import logging as log
 from .debfile import DebFile
+from .utils import get_file_stamp
 from apt_pkg import TagFile, parse_depends, version_compare
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from xml.sax.saxutils import escape
 
 
 class Package:
+    # We keep the packages of all suites, components and architectures in memory at once,
+    # so they should be as small as possible.
+    __slots__ = ('name', 'version', 'arch', 'maintainer', 'size', '_filename',
+                 '_raw_description', '_l10n', '_description', '_debfile', '_depends', '_index')
 
     def __init__(self, name, version, arch, fname=None):
         self.name = name
@@ -36,13 +48,46 @@ class Package:
         self.arch = arch
         self.filename = fname
         self.maintainer = None
+        self.size = 0
 
-        self._description = dict()
+        # descriptions as given to set_description() and from the shared translations,
+        # they are only converted to HTML when they are needed
+        self._raw_description = None
+        self._l10n = None
+        self._description = None
         self._debfile = None
+        # the names of the packages this one depends on, and the dict of name -> Package
+        # of its index, shared by all its packages, to resolve them
         self._depends = list()
+        self._index = None
+
+    def __getstate__(self):
+        state = dict((slot, getattr(self, slot)) for slot in self.__slots__)
+        # don't drag the translations of all other packages along
+        state['_raw_description'] = self._get_raw_descriptions()
+        state['_l10n'] = None
+        state['_index'] = None
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
 
     @property
     def depends(self):
+        '''
+        The packages this one depends on, as far as they are in the same index.
+        '''
+        if not self._index:
+            return list()
+        return [self._index[name] for name in self._depends if name in self._index]
+
+    @property
+    def depends_names(self):
+        '''
+        The names of all packages this one depends on, including alternatives.
+        This is kept when the package is sent to another process, unlike 'depends'.
+        '''
         return self._depends
 
     @property
@@ -56,6 +101,10 @@ class Package:
 
     @property
     def description(self):
+        if self._description is None:
+            self._description = dict()
+            for locale, desc in self._get_raw_descriptions().items():
+                self._description[locale] = self._description_to_html(desc)
         return self._description
 
     @property
@@ -83,86 +132,391 @@ class Package:
     def set_description(self, locale, desc):
         if not desc:
             return
+        if self._raw_description is None:
+            self._raw_description = dict()
+        self._raw_description[locale] = desc
+        self._description = None
+
+
+    def set_translations(self, l10n):
+        '''
+        Take the descriptions of this package from 'l10n', a mapping of package name ->
+        dict of locale -> description (like Translations), which is shared by many packages.
+        '''
+
+        self._l10n = l10n
+        self._description = None
+
+
+    def _get_raw_descriptions(self):
+        descs = dict()
+        if self._l10n:
+            for locale, desc in self._l10n.get(self.name, dict()).items():
+                if desc:
+                    descs[locale] = desc
+        if self._raw_description:
+            descs.update(self._raw_description)
+        return descs
+
+
+    def _description_to_html(self, desc):
         if desc.startswith('<p>'):
-            self._description[locale] = desc
-        else:
-            desc_lines = desc.split('\n')
-            desc_as = '<p>'
-            for line in desc_lines:
-                line = line.strip()
-                if line == '.':
-                    desc_as = desc_as.strip()
-                    desc_as += '</p><p>'
-                    continue
-                desc_as += escape(line)
-                desc_as += " "
-            desc_as = desc_as.strip()
-            desc_as += '</p>'
-            self._description[locale] = desc_as
+            return desc
+        desc_lines = desc.split('\n')
+        desc_as = '<p>'
+        for line in desc_lines:
+            line = line.strip()
+            if line == '.':
+                desc_as = desc_as.strip()
+                desc_as += '</p><p>'
+                continue
+            desc_as += escape(line)
+            desc_as += " "
+        desc_as = desc_as.strip()
+        desc_as += '</p>'
+        return desc_as
 
 
     def has_description(self):
-        return True if self.description else False
+        if self._description is not None:
+            return True if self._description else False
+        return True if self._get_raw_descriptions() else False
+
+
+# the package indices we have read in this process, by the stamps of their files
+_package_indices = dict()
+# the Translations of all suites and components we have looked at in this process
+_translations = dict()
+# where we keep the translated descriptions
+_translations_dir = None
+# where we keep the package indices between runs, if at all
+_package_index_dir = None
+
+# bump this if the data we keep for a package changes
+PACKAGE_INDEX_VERSION = 4
+
+
+def set_package_index_dir(path):
+    '''
+    Keep the package indices we read in 'path', so they don't need to be parsed
+    again in later runs, unless the archive has changed.
+    '''
+
+    global _package_index_dir
+    if not os.path.exists(path):
+        os.makedirs(path)
+    _package_index_dir = path
+
+
+def set_translations_dir(path):
+    '''
+    Keep the translated descriptions in 'path', so they don't need to be read
+    again in later runs, unless the Translation files have changed.
+    Without it, they are kept in a temporary directory.
+    '''
+
+    global _translations_dir
+    if not os.path.exists(path):
+        os.makedirs(path)
+    _translations_dir = path
+
+
+def _get_l10n_paths(archive_root, suite, component):
+    l10n_glob = os.path.join(archive_root, 'dists', suite, component, 'i18n', 'Translation-*.xz')
+    return sorted(set(glob.glob(l10n_glob)))
+
+
+def _load_package_index(index_fname, stamp, translations=None):
+    try:
+        with open(index_fname, 'rb') as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("Could not read package index '%s': %s" % (index_fname, str(e)))
+        return None
+    if data.get('stamp') != stamp:
+        return None
+
+    package_dict = dict()
+    for name, version, arch, fname, maintainer, size, description, translated, depends in data['packages']:
+        pkg = Package(name, version, sys.intern(arch), fname)
+        pkg.maintainer = sys.intern(maintainer) if maintainer else None
+        pkg.size = size
+        pkg._raw_description = description or None
+        if translated:
+            pkg._l10n = translations
+        pkg._depends = [sys.intern(dep) for dep in depends]
+        pkg._index = package_dict
+        package_dict[name] = pkg
+    return package_dict
+
+
+def _save_package_index(index_fname, stamp, package_dict):
+    packages = list()
+    for pkg in package_dict.values():
+        # the translations are kept separately
+        packages.append((pkg.name, pkg.version, pkg.arch, pkg.filename, pkg.maintainer, pkg.size,
+                         pkg._raw_description, pkg._l10n is not None, pkg.depends_names))
+
+    try:
+        fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(index_fname))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'stamp': stamp, 'packages': packages}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fname, index_fname)
+    except Exception as e:
+        log.warning("Could not write package index '%s': %s" % (index_fname, str(e)))
 
 
 def read_packages_dict_from_file(archive_root, suite, component, arch, with_description=False):
+    '''
+    Returns a dict of package name -> Package with the newest version of each package
+    in the Packages index of the given suite/component/arch.
+    Every index is parsed only once per process, or even only once until it changes
+    if set_package_index_dir() was called. All callers get the same Package objects.
+    '''
+
     source_path = archive_root + "/dists/%s/%s/binary-%s/Packages.gz" % (suite, component, arch)
 
-    pkgl10n = defaultdict(dict)
+    stamp = [PACKAGE_INDEX_VERSION, archive_root, get_file_stamp(source_path)]
     if with_description:
-        l10n_glob = os.path.join(archive_root, 'dists', suite, component, 'i18n', 'Translation-*.xz')
-        for path in set(glob.glob(l10n_glob)):
-            # Translation-de_DE.xz -> ['Translation', 'de_DE', 'xz']
-            lang = re.findall(r"[^-\.]+", os.path.basename(path))[1]
-            log.info("Retrieving translations for the '%s' language from '%s'" % (lang, path))
-            try:
-                with tempfile.TemporaryFile(mode='w+b') as tf:
-                    with lzma.open(path, 'rb') as f:
-                        tf.write(f.read())
-                    tf.seek(0)
-                    for section in TagFile(tf):
-                        pkgname = section.get('Package')
-                        if not pkgname:
-                            continue
-                        pkgl10n[pkgname][lang] = "\n".join(section.get('Description-%s' % lang).splitlines()[1:])
-                        if lang == 'en': # en supplies C too
-                            pkgl10n[pkgname]['C'] = pkgl10n[pkgname][lang]
-            except Exception as e:
-                log.warning("Could not use i18n file '{}': {}".format(l10n_en_source_path, str(e)))
+        for path in _get_l10n_paths(archive_root, suite, component):
+            stamp.append((os.path.basename(path), get_file_stamp(path)))
+    stamp = tuple(stamp)
+    key = (source_path, with_description)
+
+    index = _package_indices.get(key)
+    if index and index[0] == stamp:
+        return dict(index[1])
+
+    translations = None
+    if with_description:
+        translations = _get_translations(archive_root, suite, component)
+
+    index_fname = None
+    if _package_index_dir:
+        index_name = hashlib.sha1(("%s;%s" % key).encode('utf-8')).hexdigest()
+        index_fname = os.path.join(_package_index_dir, index_name + ".pickle")
+        package_dict = _load_package_index(index_fname, stamp, translations)
+        if package_dict is not None:
+            _package_indices[key] = (stamp, package_dict)
+            return dict(package_dict)
 
+    package_dict = _read_packages_dict_from_file(archive_root, source_path, translations)
+    _package_indices[key] = (stamp, package_dict)
+    if index_fname:
+        _save_package_index(index_fname, stamp, package_dict)
+    return dict(package_dict)
+
+
+def _read_translations(path, lang):
+    '''
+    Returns a dict of package name -> long description in 'lang' from the Translation file 'path'.
+    The file is read stanza by stanza, so it never has to be in memory as a whole.
+    '''
+
+    translations = dict()
+    desc_field = 'Description-%s:' % (lang)
+    pkgname = None
+    desc = None
+    in_desc = False
+    with lzma.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith((' ', '\t')):
+                # continuation line of the current field
+                if in_desc:
+                    desc.append(line.rstrip('\n'))
+                continue
+
+            in_desc = False
+            if not line.strip():
+                # end of stanza
+                if pkgname and desc is not None:
+                    translations[pkgname] = "\n".join(desc)
+                pkgname = None
+                desc = None
+            elif line.startswith('Package:'):
+                pkgname = line[8:].strip()
+            elif line.startswith(desc_field):
+                # the first line is the short description, we only want the long one
+                desc = list()
+                in_desc = True
+        if pkgname and desc is not None:
+            translations[pkgname] = "\n".join(desc)
+    return translations
+
+
+def _get_l10n_lang(path):
+    # Translation-de_DE.xz -> ['Translation', 'de_DE', 'xz']
+    return re.findall(r"[^-\.]+", os.path.basename(path))[1]
+
+
+def _read_l10n_files(paths, read_ahead=2):
+    '''
+    Read the Translation files 'paths', yields tuples of language and dict of
+    package name -> long description, in the order of 'paths'.
+    At most 'read_ahead' languages are kept in memory at a time, including the one
+    the caller is working with.
+    '''
+
+    def read_language(path):
+        lang = _get_l10n_lang(path)
+        log.info("Retrieving translations for the '%s' language from '%s'" % (lang, path))
+        try:
+            return lang, _read_translations(path, lang)
+        except Exception as e:
+            log.warning("Could not use i18n file '{}': {}".format(path, str(e)))
+            return lang, dict()
+
+    if not paths:
+        return
+    # Only the decompression releases the GIL, the parsing runs one thread at a time.
+    # Still, the next file can be read while the caller stores the previous one.
+    pending = deque()
+    with ThreadPoolExecutor(max(1, min(len(paths), read_ahead - 1))) as executor:
+        for path in paths:
+            pending.append(executor.submit(read_language, path))
+            if len(pending) >= read_ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class Translations:
+    '''
+    The translated long descriptions of the packages of a suite/component, read from
+    its Translation files. They are kept in a LMDB database on disk, so only the
+    descriptions of the packages we actually look at are loaded into memory.
+    Behaves like a read-only dict of package name -> dict of language -> description.
+    '''
+
+    def __init__(self, path):
+        self._env = lmdb.open(path, max_dbs=3, map_size=pow(1024, 4), metasync=False, sync=False)
+        # "<language>\0<package name>" -> description
+        self._descdb = self._env.open_db(b'descriptions')
+        # the names of all packages with descriptions
+        self._pkgdb = self._env.open_db(b'packages')
+        # the stamp of the Translation files and the list of languages
+        self._infodb = self._env.open_db(b'info')
+        self._languages = None
+
+
+    def get_stamp(self):
+        with self._env.begin(db=self._infodb) as txn:
+            stamp = txn.get(b'stamp')
+        return str(stamp, 'utf-8') if stamp else None
+
+
+    def _get_languages(self):
+        if self._languages is None:
+            with self._env.begin(db=self._infodb) as txn:
+                self._languages = str(txn.get(b'languages', b''), 'utf-8').split()
+        return self._languages
+
+
+    def update(self, paths, stamp):
+        '''
+        Replace all descriptions with the ones from the Translation files 'paths'.
+        '''
+
+        with self._env.begin(write=True) as txn:
+            txn.delete(b'stamp', db=self._infodb)
+            txn.drop(self._descdb, delete=False)
+            txn.drop(self._pkgdb, delete=False)
+        self._languages = None
+
+        # We write one language after the other, so we never have all of them in memory,
+        # and every language in the order of the keys, so LMDB can fill its pages completely.
+        paths = sorted(paths, key=lambda path: bytes(_get_l10n_lang(path) + '\0', 'utf-8'))
+        languages = list()
+        names = set()
+        for lang, translations in _read_l10n_files(paths):
+            prefix = bytes(lang + '\0', 'utf-8')
+            with self._env.begin(write=True, db=self._descdb) as txn:
+                txn.cursor().putmulti(((prefix + bytes(name, 'utf-8'), bytes(desc, 'utf-8'))
+                                        for name, desc in sorted(translations.items())), append=True)
+            languages.append(lang)
+            names.update(translations.keys())
+
+        with self._env.begin(write=True) as txn:
+            txn.cursor(db=self._pkgdb).putmulti(((bytes(name, 'utf-8'), b'') for name in sorted(names)), append=True)
+            txn.put(b'languages', bytes(' '.join(languages), 'utf-8'), db=self._infodb)
+            txn.put(b'stamp', bytes(stamp, 'utf-8'), db=self._infodb)
+
+
+    def get(self, pkgname, default=None):
+        name = bytes(pkgname, 'utf-8')
+        descs = dict()
+        with self._env.begin(db=self._descdb) as txn:
+            if txn.get(name, db=self._pkgdb) is None:
+                return default
+            for lang in self._get_languages():
+                desc = txn.get(bytes(lang + '\0', 'utf-8') + name)
+                if desc:
+                    descs[lang] = str(desc, 'utf-8')
+        if 'en' in descs: # en supplies C too
+            descs['C'] = descs['en']
+        return descs
+
+
+    def __contains__(self, pkgname):
+        with self._env.begin(db=self._pkgdb) as txn:
+            return txn.get(bytes(pkgname, 'utf-8')) is not None
+
+
+def _get_translations(archive_root, suite, component):
+    '''
+    Returns the Translations of the packages in suite/component. They are the same for
+    all architectures, so every Translation file is only read once, until it changes.
+    '''
+
+    global _translations_dir
+    key = (archive_root, suite, component)
+    translations = _translations.get(key)
+    if not translations:
+        if not _translations_dir:
+            _translations_dir = tempfile.mkdtemp(prefix="dep11-translations-")
+            atexit.register(shutil.rmtree, _translations_dir, True)
+        path = os.path.join(_translations_dir, hashlib.sha1(("%s;%s;%s" % key).encode('utf-8')).hexdigest())
+        os.makedirs(path, exist_ok=True)
+        # LMDB environments must only be opened once per process
+        translations = Translations(path)
+        _translations[key] = translations
+
+    paths = _get_l10n_paths(archive_root, suite, component)
+    stamp = repr([(os.path.basename(path), get_file_stamp(path)) for path in paths])
+    if translations.get_stamp() != stamp:
+        translations.update(paths, stamp)
+    return translations
+
+
+def _read_packages_dict_from_file(archive_root, source_path, translations=None):
     f = gzip.open(source_path, 'rb')
     tagf = TagFile(f)
     package_dict = dict()
-    all_packages = dict()
-    # we might see a package for the first time as a dependency, not as the package itself
-    # in that case, store this in a (Package, dependency) list to come back to at the end
-    pkg_depends_todo = list()
     for section in tagf:
-        pkg = Package(section['Package'], section['Version'], section['Architecture'])
+        # the same architectures and maintainers show up for many packages, share their strings
+        pkg = Package(section['Package'], section['Version'], sys.intern(section['Architecture']))
         if not section.get('Filename'):
-            print("Package %s-%s has no filename specified." % (pkg['name'], pkg['version']))
+            print("Package %s-%s has no filename specified." % (pkg.name, pkg.version))
             continue
         pkg.filename = os.path.join(archive_root, section['Filename'])
-        all_packages[pkg.name] = pkg
-        pkg.maintainer = section['Maintainer']
-        try:
-            # Depends: a | b, c -> [[a, b], c]
-            depends = parse_depends(section['Depends'])
-            for depgroup in depends:
+        pkg.maintainer = sys.intern(section['Maintainer'])
+        pkg.size = int(section.get('Size', 0))
+        # Depends: a | b, c -> [[a, b], c]
+        # We only store the names, they are resolved through the index when needed,
+        # no matter in which order the packages are listed.
+        if section.get('Depends'):
+            for depgroup in parse_depends(section['Depends']):
                 for (dependency, _, _) in depgroup:
-                    if dependency in all_packages:
-                        # we've seen it already, so put it on the list
-                        pkg.depends.append(all_packages[pkg])
-                    else:
-                        # we haven't, record that we need to come back to this later
-                        pkg_depends_todo.append((pkg, dependency))
-        except KeyError:
-            pass
-
-        if with_description:
-            if pkg.name in pkgl10n:
-                for lang in pkgl10n[pkg.name]:
-                    pkg.set_description(lang, pkgl10n[pkg.name][lang])
+                    dependency = sys.intern(dependency)
+                    if dependency not in pkg._depends:
+                        pkg._depends.append(dependency)
+        pkg._index = package_dict
+
+        if translations is not None:
+            if pkg.name in translations:
+                pkg.set_translations(translations)
             else:
                 pkg.set_description('C', section.get('Description'))
 
@@ -172,10 +526,6 @@ def read_packages_dict_from_file(archive_root, suite, component, arch, with_desc
             if compare >= 0:
                 continue
         package_dict[pkg.name] = pkg
-    # revisit all deferred dependencies and fill the corresponding Package in
-    for (pkg, dep) in pkg_depends_todo:
-        if dep in all_packages:
-            pkg.depends.append(all_packages[dep])
     f.close()
 
     return package_dict
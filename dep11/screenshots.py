@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import hashlib
+import tempfile
+import threading
+import logging as log
+
+from PIL import Image
+
+from .utils import link_or_copy
+from .downloader import get_downloader
+from .imagepool import get_image_pool
+
+# the sizes of the thumbnails we create for every screenshot, largest first
+SCREENSHOT_SIZES = ['1248x702', '752x423', '624x351', '112x63']
+
+
+def get_thumbnail_sizes(width, height):
+    '''
+    Returns the thumbnail sizes for a screenshot of the given size,
+    we don't scale screenshots up.
+    '''
+
+    sizes = list()
+    for size in SCREENSHOT_SIZES:
+        wd, ht = size.split('x')
+        if int(wd) <= width and int(ht) <= height:
+            sizes.append(size)
+    return sizes
+
+
+def write_file_atomic(fname, write):
+    '''
+    Create the file 'fname' by calling 'write' with a file object, so that
+    nobody ever sees it incomplete, even if others create it at the same time.
+    '''
+
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname), suffix=".new")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp_fname, 0o644)
+        os.replace(tmp_fname, fname)
+    except:
+        os.remove(tmp_fname)
+        raise
+
+
+def scale_screenshot(img, sizes, blob_dir):
+    '''
+    Scale the decoded screenshot 'img' to all thumbnail 'sizes', largest first.
+    Every thumbnail is derived from the previous, larger one, so
+    only the first one has to be scaled down from the full image.
+    '''
+
+    for size in sizes:
+        wd, ht = [int(x) for x in size.split('x')]
+        # Shrink huge images with a cheap box filter first, leaving at least
+        # a factor of two for the resampling filter to keep the quality.
+        factor = min(img.width // (wd * 2), img.height // (ht * 2))
+        if factor >= 2:
+            img = img.reduce(factor)
+        img = img.resize((wd, ht), Image.LANCZOS)
+
+        write_file_atomic(os.path.join(blob_dir, "%s.png" % (size)), lambda f: img.save(f, format="PNG"))
+
+
+def store_screenshot(blob_dir, data):
+    '''
+    Add the screenshot image 'data' to the screenshot store at 'blob_dir', together with its thumbnails.
+    '''
+
+    os.makedirs(blob_dir, exist_ok=True)
+
+    # others might be storing the same image right now
+    source = os.path.join(blob_dir, "source.png")
+    write_file_atomic(source, lambda f: f.write(data))
+
+    img = Image.open(source)
+    sizes = get_thumbnail_sizes(*img.size)
+    if sizes:
+        # let JPEG images be decoded at a lower resolution right away,
+        # if the largest thumbnail doesn't need the full one
+        img.draft(img.mode, [int(x) for x in sizes[0].split('x')])
+    # decode the image only once, for all thumbnails
+    img.load()
+    # reduce() doesn't work on palette and bilevel images, and resizing them
+    # would fall back to the nearest-neighbour filter
+    if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        img = img.convert('RGBA')
+    scale_screenshot(img, sizes, blob_dir)
+    img.close()
+
+
+def screenshot_stored(blob_dir):
+    '''
+    Check whether the screenshot store has the source image at 'blob_dir' and all of its thumbnails.
+    '''
+
+    try:
+        with Image.open(os.path.join(blob_dir, "source.png")) as img:
+            sizes = get_thumbnail_sizes(*img.size)
+    except OSError:
+        return False
+    return all(os.path.isfile(os.path.join(blob_dir, "%s.png" % (size))) for size in sizes)
+
+
+class ScreenshotFetcher:
+    '''
+    Downloads, stores and scales the screenshots of components in the background.
+    Nothing waits for a download: every step is started by the completion of the previous one,
+    and whoever asked for the screenshots is called back when all of them are done.
+    Every distinct image is stored and scaled only once, the media directories
+    of the components only contain hardlinks to the screenshot store.
+    '''
+
+    def __init__(self, dcache):
+        self._dcache = dcache
+        self._lock = threading.Lock()
+        # HTTP cache entries of the screenshots we downloaded, which might not be in the cache yet
+        self._http_cache_updates = dict()
+
+
+    def _get_http_cache_entry(self, url):
+        '''
+        Returns what we know about the screenshot at 'url', if it is still in the
+        screenshot store.
+        '''
+
+        with self._lock:
+            entry = self._http_cache_updates.get(url)
+        if not entry:
+            entry = self._dcache.get_http_cache_entry(url)
+        if not entry:
+            return None
+
+        if not os.path.isfile(os.path.join(self._dcache.screenshot_dir, entry['path'])):
+            return None
+        return entry
+
+
+    def _start_download(self, url, entry, done):
+        '''
+        Download the screenshot at 'url' and make sure it is in the screenshot store, then call
+        'done' with the response, the hash of the image, an error message (if any) and the
+        HTTP cache entry the response refers to.
+        '''
+
+        headers = dict()
+        if entry:
+            # only download the screenshot if it was changed since we fetched it the last time
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        download = get_downloader().fetch(url, headers)
+        download.add_done_callback(lambda download: self._downloaded(url, entry, download, done))
+
+
+    def _downloaded(self, url, entry, download, done):
+        try:
+            image_req = download.result()
+        except Exception as e:
+            done(None, None, str(e), None)
+            return
+
+        try:
+            if image_req.status == 304 and entry:
+                if screenshot_stored(self._dcache.get_screenshot_blob_dir(entry['sha256'])):
+                    done(image_req, entry['sha256'], None, entry)
+                else:
+                    # our copy is gone, so we need the whole image again
+                    self._start_download(url, None, done)
+                return
+            if image_req.status != 200:
+                done(image_req, None, None, None)
+                return
+
+            sha256 = hashlib.sha256(image_req.data).hexdigest()
+            blob_dir = self._dcache.get_screenshot_blob_dir(sha256)
+            if screenshot_stored(blob_dir):
+                # we know this image already, from this or another URL
+                done(image_req, sha256, None, None)
+                return
+            scaling = get_image_pool().submit(store_screenshot, blob_dir, image_req.data)
+            scaling.add_done_callback(lambda scaling: self._stored(image_req, sha256, scaling, done))
+        except Exception as e:
+            done(None, None, str(e), None)
+
+
+    def _stored(self, image_req, sha256, scaling, done):
+        error_msg = None
+        try:
+            scaling.result()
+        except Exception as e:
+            blob_dir = self._dcache.get_screenshot_blob_dir(sha256)
+            # filter out the absolute path: we shouldn't add it
+            error_msg = str(e).replace(blob_dir, "") or "Unable to read the image."
+            # the fetch must always finish, even if we can't clean up
+            try:
+                self._dcache.remove_screenshot_blob(sha256)
+            except Exception as e:
+                log.error("Unable to remove the incomplete screenshot '%s': %s" % (blob_dir, str(e)))
+        done(image_req, sha256, error_msg, None)
+
+
+    def _place_screenshot(self, shot, sha256, imgsrc, cpt_scr_url):
+        '''
+        Hardlink the source image and thumbnails of the screenshot with hash 'sha256' from the
+        screenshot store to 'imgsrc' and the thumbnail directories next to it.
+        Returns the size of the source image, or None if the store doesn't have it.
+        '''
+
+        blob_dir = self._dcache.get_screenshot_blob_dir(sha256)
+        scr_dir = os.path.dirname(os.path.dirname(imgsrc))
+        name = os.path.basename(imgsrc)
+
+        try:
+            # this only reads the image header
+            with Image.open(os.path.join(blob_dir, "source.png")) as img:
+                wd, ht = img.size
+            sizes = get_thumbnail_sizes(wd, ht)
+
+            files = [("source.png", imgsrc)]
+            for size in sizes:
+                files.append(("%s.png" % (size), os.path.join(scr_dir, size, name)))
+            for blob, dest in files:
+                blob = os.path.join(blob_dir, blob)
+                if not os.path.isfile(blob):
+                    return None
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                link_or_copy(blob, dest)
+        except OSError:
+            return None
+
+        shot.set_source_image("%s/source/%s" % (cpt_scr_url, name), width=wd, height=ht)
+        for size in sizes:
+            wd, ht = size.split('x')
+            shot.add_thumbnail("%s/%s/%s" % (cpt_scr_url, size, name), width=wd, height=ht)
+        return (shot.source_image['width'], shot.source_image['height'])
+
+
+    def _make_http_cache_entry(self, url, image_req, sha256, width, height, old_entry=None):
+        '''
+        Record which screenshot we got from 'url', so we can skip downloading
+        and scaling it again if it didn't change.
+        '''
+
+        blob_dir = self._dcache.get_screenshot_blob_dir(sha256)
+        entry = {'etag': image_req.headers.get('ETag'),
+                 'last_modified': image_req.headers.get('Last-Modified'),
+                 'sha256': sha256,
+                 'path': os.path.relpath(os.path.join(blob_dir, "source.png"), self._dcache.screenshot_dir),
+                 'width': int(width),
+                 'height': int(height)}
+        if old_entry and image_req.status == 304:
+            # a "not modified" reply may omit the validators
+            entry['etag'] = entry['etag'] or old_entry.get('etag')
+            entry['last_modified'] = entry['last_modified'] or old_entry.get('last_modified')
+        with self._lock:
+            self._http_cache_updates[url] = entry
+        return entry
+
+
+    def _add_screenshots(self, cpt, cpt_export_path, results, http_cache_updates, cpt_public_url=""):
+        '''
+        Add the screenshots we fetched to the component, and hints about all which failed.
+        '''
+
+        shots = list()
+        cnt = 1
+        for shot in cpt.screenshots:
+            origin_url = shot.source_image['url']
+            if not origin_url:
+                # url empty? skip this screenshot
+                continue
+            path     = cpt.build_media_path(cpt_export_path, "screenshots")
+            base_url = cpt.build_media_path(cpt_public_url,  "screenshots")
+            imgsrc   = os.path.join(path, "source", "scr-%s.png" % (str(cnt)))
+
+            image_req, sha256, error_msg, old_entry = results[origin_url]
+            if not image_req:
+                cpt.add_hint("screenshot-download-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': error_msg})
+                continue
+            if not sha256:
+                msg = "HTTP status code was %i." % (image_req.status)
+                cpt.add_hint("screenshot-download-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': msg})
+                continue
+            if error_msg:
+                cpt.add_hint("screenshot-read-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': error_msg})
+                continue
+
+            size = self._place_screenshot(shot, sha256, imgsrc, base_url)
+            if not size:
+                cpt.add_hint("screenshot-read-error", {'url': origin_url, 'cpt_id': cpt.cid, 'error': "Unable to store the image."})
+                continue
+            if origin_url not in http_cache_updates:
+                http_cache_updates[origin_url] = self._make_http_cache_entry(origin_url, image_req, sha256, *size, old_entry=old_entry)
+            shots.append(shot)
+            cnt = cnt + 1
+
+        cpt.screenshots = shots
+
+
+    def fetch(self, cpts, callback):
+        '''
+        Fetch the screenshots of 'cpts', a list of (component, export path) tuples, in the background.
+        When all of them are done, 'callback' is called with the HTTP cache entries of the
+        screenshots as dict of URL -> entry, for writing them to the cache.
+        '''
+
+        urls = set()
+        for cpt, export_path in cpts:
+            for shot in (cpt.screenshots or []):
+                if shot.source_image['url']:
+                    urls.add(shot.source_image['url'])
+
+        results = dict()
+        pending = [len(urls)]
+        lock = threading.Lock()
+
+        def finish():
+            http_cache_updates = dict()
+            try:
+                for cpt, export_path in cpts:
+                    if cpt.screenshots:
+                        self._add_screenshots(cpt, export_path, results, http_cache_updates)
+            except Exception as e:
+                log.error("Unable to add screenshots: %s" % (str(e)))
+            callback(http_cache_updates)
+
+        def done(url, image_req, sha256, error_msg, entry):
+            with lock:
+                results[url] = (image_req, sha256, error_msg, entry)
+                pending[0] -= 1
+                last = pending[0] == 0
+            if last:
+                finish()
+
+        if not urls:
+            finish()
+            return
+        for url in urls:
+            try:
+                self._start_download(url, self._get_http_cache_entry(url),
+                                     lambda *result, url=url: done(url, *result))
+            except Exception as e:
+                done(url, None, None, str(e), None)
+
+
+    def fetch_wait(self, cpts):
+        '''
+        Fetch the screenshots of 'cpts' like fetch(), but wait until all are done and
+        return the HTTP cache entries.
+        '''
+
+        finished = threading.Event()
+        updates = dict()
+
+        def callback(http_cache_updates):
+            updates.update(http_cache_updates)
+            finished.set()
+
+        self.fetch(cpts, callback)
+        finished.wait()
+        return updates
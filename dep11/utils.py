@@ -17,6 +17,7 @@
 
 import os
 import sys
+import shutil
 import yaml
 
 
@@ -53,6 +54,72 @@ def build_cpt_global_id(cptid, checksum, allow_no_checksum=False):
     return gid
 
 
+def get_file_stamp(fname):
+    '''
+    Returns a string which changes whenever the file at 'fname' is modified.
+    '''
+
+    st = os.stat(fname)
+    return "%i:%i" % (st.st_mtime, st.st_size)
+
+
+def link_or_copy(src, dest):
+    '''
+    Place the file 'src' at 'dest', as hardlink if possible.
+    '''
+
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        # hardlinks don't work across filesystems
+        shutil.copyfile(src, dest)
+
+
+def is_metainfo_file(fname):
+    '''
+    Check if the file at path 'fname' (relative to the package root) is a .desktop
+    or AppStream metainfo file we need to look at.
+    '''
+
+    if fname.startswith('usr/share/applications/'):
+        return fname.endswith('.desktop')
+    if fname.startswith(('usr/share/metainfo/', 'usr/share/appdata/')):
+        return fname.endswith('.xml')
+    return False
+
+
+def is_icon_file(fname):
+    '''
+    Check if the file at path 'fname' might be an icon we could use.
+    '''
+
+    return fname.startswith(('usr/share/icons/', 'usr/share/pixmaps/'))
+
+
+def is_image_file(fname):
+    '''
+    Check if the file at path 'fname' is an image which could be used as icon if a
+    metainfo or .desktop file refers to it by its absolute path.
+    Only images in the data directories below usr/share/ are considered, like the ones
+    in usr/share/icons/, usr/share/pixmaps/ or usr/share/<package>/. Documentation and
+    help pages ship lots of images which are never used as icons.
+    Every image we accept here makes the Contents index larger, all others are only
+    found by looking into the .deb files of the direct dependencies, which is slower.
+    '''
+
+    if not fname.startswith('usr/share/'):
+        return False
+    if fname.startswith(('usr/share/doc/', 'usr/share/help/', 'usr/share/gtk-doc/', 'usr/share/man/', 'usr/share/locale/')):
+        return False
+    return fname.lower().endswith(('.png', '.svg', '.gif', '.svgz', '.jpg'))
+
+
+def is_interesting_file(fname):
+    return is_metainfo_file(fname) or is_icon_file(fname)
+
+
 def get_data_dir():
     """Return data directory path. Check first in master, then virtualenv or installed system version."""
 
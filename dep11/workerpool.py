@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import time
+import pickle
+import resource
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import heapq
+import logging as log
+
+
+def _get_rss():
+    '''
+    Returns the resident set size of the current process in bytes.
+    '''
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # peak usage in KiB, that's good enough as fallback
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# objects shared with the worker process by WorkerPool.share()
+_shared_objects = dict()
+
+def get_shared(key):
+    '''
+    Get an object which has been shared with all workers using WorkerPool.share().
+    Must only be called from a task running in a worker process.
+    '''
+
+    return _shared_objects[key]
+
+
+class RemoteError(Exception):
+    '''
+    An exception raised in a worker, which could not be passed to us.
+    '''
+    pass
+
+
+def _worker_main(conn, initializer, initargs, max_rss):
+    if initializer:
+        initializer(*initargs)
+    conn.send(('ready', None, False))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+
+        if msg[0] == 'share':
+            _shared_objects[msg[1]] = pickle.loads(msg[2])
+            continue
+
+        func, args = msg[1:]
+        try:
+            reply = ('ok', func(*args))
+        except Exception as e:
+            e.remote_traceback = traceback.format_exc()
+            reply = ('error', e)
+
+        # stop accepting work if we've grown too big, the pool will start a fresh worker
+        retire = bool(max_rss) and _get_rss() > max_rss
+        try:
+            conn.send(reply + (retire,))
+        except Exception as e:
+            # the result or exception can't be pickled
+            conn.send(('error', RemoteError("%s\n%s" % (str(e), reply[1])), retire))
+        if retire:
+            break
+    conn.close()
+
+
+class WorkerPool:
+    '''
+    A pool of long-lived worker processes, similar to multiprocessing.Pool.
+    Workers are started through the forkserver, so expensive modules only need to be imported
+    once, and are kept for the whole run. A worker is only replaced if its memory usage grows
+    above 'max_rss' bytes after a task, or if it died.
+    Large objects many tasks need can be shared with the workers, so they are only sent once
+    to every worker instead of with every task.
+    '''
+
+    def __init__(self, processes=None, initializer=None, initargs=(), max_rss=None, preload=None):
+        self._ctx = mp.get_context('forkserver')
+        if preload:
+            # this only has an effect if the forkserver isn't running yet
+            self._ctx.set_forkserver_preload(preload)
+
+        self._processes = processes or os.cpu_count() or 1
+        self._initializer = initializer
+        self._initargs = initargs
+        self._max_rss = max_rss
+
+        self._lock = threading.Lock()
+        # heap of (-priority, sequence number, task)
+        self._tasks = list()
+        self._task_seq = 0
+        self._workers = list()
+        self._shared = dict()
+        self._closed = False
+        self._terminated = False
+        self._wakeup_pending = False
+        self._wakeup_r, self._wakeup_w = self._ctx.Pipe(duplex=False)
+
+        self.workers_started = 0
+        self.workers_retired = 0
+        self.startup_time = 0
+
+        for i in range(self._processes):
+            self._start_worker()
+
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+
+    def _start_worker(self):
+        conn, child_conn = self._ctx.Pipe()
+        proc = self._ctx.Process(target=_worker_main,
+                                 args=(child_conn, self._initializer, self._initargs, self._max_rss),
+                                 daemon=True)
+        worker = {'process': proc,
+                  'conn': conn,
+                  'started': time.time(),
+                  'ready': False,
+                  'shared': set(),
+                  'task': None}
+        proc.start()
+        child_conn.close()
+        self._workers.append(worker)
+        self.workers_started += 1
+
+
+    def _wakeup(self):
+        # must be called with the lock held
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._wakeup_w.send(None)
+
+
+    def share(self, obj):
+        '''
+        Make 'obj' available to tasks in the workers, which can get it with get_shared()
+        using the returned key. The object is serialized only once, so later changes to it
+        are not seen by the workers.
+        '''
+
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            key = len(self._shared)
+            self._shared[key] = data
+        return key
+
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None, shared=(), priority=0):
+        '''
+        Run 'func' with 'args' in a worker. 'shared' are the keys of all shared objects
+        the task needs. Queued tasks with a higher priority are started first, tasks with
+        the same priority in the order they were added.
+        '''
+
+        with self._lock:
+            if self._closed:
+                raise ValueError("Pool not running")
+            heapq.heappush(self._tasks, (-priority, self._task_seq, (func, args, callback, error_callback, shared)))
+            self._task_seq += 1
+            self._wakeup()
+
+
+    def _assign_tasks(self):
+        for worker in self._workers:
+            if not worker['ready'] or worker['task']:
+                continue
+            with self._lock:
+                if not self._tasks:
+                    return
+                task = heapq.heappop(self._tasks)[2]
+            worker['task'] = task
+            try:
+                # send the shared objects this worker doesn't have yet first
+                for key in task[4]:
+                    if key not in worker['shared']:
+                        worker['conn'].send(('share', key, self._shared[key]))
+                        worker['shared'].add(key)
+                worker['conn'].send(('task', task[0], task[1]))
+            except Exception as e:
+                worker['task'] = None
+                self._call(task[3], e)
+
+
+    def _call(self, callback, arg):
+        if not callback:
+            return
+        try:
+            callback(arg)
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+
+    def _handle_message(self, worker):
+        try:
+            status, value, retire = worker['conn'].recv()
+        except (EOFError, OSError):
+            # the worker died
+            worker['process'].join()
+            self._workers.remove(worker)
+            task = worker['task']
+            if task:
+                self._call(task[3], RemoteError("Worker process died with exit code %s" % (str(worker['process'].exitcode))))
+            if self._terminated:
+                return
+            if worker['ready']:
+                self._start_worker()
+                return
+
+            # it didn't even get through its initialization, so trying again won't help
+            log.error("Worker process failed to start, exit code %s" % (str(worker['process'].exitcode)))
+            if not self._workers:
+                with self._lock:
+                    tasks = [entry[2] for entry in self._tasks]
+                    self._tasks.clear()
+                for task in tasks:
+                    self._call(task[3], RemoteError("No worker processes are available"))
+            return
+
+        if status == 'ready':
+            worker['ready'] = True
+            self.startup_time += time.time() - worker['started']
+        else:
+            task = worker['task']
+            worker['task'] = None
+            if status == 'ok':
+                self._call(task[2], value)
+            else:
+                self._call(task[3], value)
+
+        if retire:
+            worker['process'].join()
+            worker['conn'].close()
+            self._workers.remove(worker)
+            self.workers_retired += 1
+            self._start_worker()
+
+
+    def _dispatch(self):
+        while not self._terminated:
+            self._assign_tasks()
+
+            with self._lock:
+                finished = self._closed and not self._tasks
+            if finished and not any(w['task'] for w in self._workers):
+                break
+
+            ready = wait([w['conn'] for w in self._workers] + [self._wakeup_r])
+            for conn in ready:
+                if conn is self._wakeup_r:
+                    with self._lock:
+                        self._wakeup_r.recv()
+                        self._wakeup_pending = False
+                    continue
+                for worker in self._workers:
+                    if worker['conn'] is conn:
+                        self._handle_message(worker)
+                        break
+
+        # shut down the remaining workers
+        for worker in self._workers:
+            if self._terminated:
+                worker['process'].terminate()
+            else:
+                try:
+                    worker['conn'].send(None)
+                except OSError:
+                    pass
+        for worker in self._workers:
+            worker['process'].join()
+        self._workers = list()
+
+
+    def close(self):
+        '''
+        Don't accept new tasks anymore, the workers exit when all tasks are done.
+        '''
+
+        with self._lock:
+            self._closed = True
+            self._wakeup()
+
+
+    def terminate(self):
+        '''
+        Stop all workers immediately, dropping pending tasks.
+        '''
+
+        with self._lock:
+            self._closed = True
+            self._terminated = True
+            self._tasks.clear()
+            self._wakeup()
+        self._dispatcher.join()
+
+
+    def join(self):
+        self._dispatcher.join()
+        log.info("Started %i worker processes (%i replaced because of their memory usage), spent %.2fs on their startup." % (self.workers_started, self.workers_retired, self.startup_time))
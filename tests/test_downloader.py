@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import time
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from dep11.downloader import Downloader, DownloadError
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, data=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.clients.add(self.client_address)
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        try:
+            if self.path.startswith("/slow"):
+                time.sleep(server.delay)
+            if self.path.startswith("/redirect"):
+                self._reply(302, headers={'Location': "/data"})
+            elif self.path == "/loop":
+                self._reply(301, headers={'Location': "/loop"})
+            elif self.path == "/cached" and (self.headers.get("If-None-Match") == '"abc"' or
+                                             self.headers.get("If-Modified-Since")):
+                self._reply(304, headers={'ETag': '"abc"'})
+            else:
+                self._reply(200, bytes(self.path, 'utf-8'), headers={'ETag': '"abc"'})
+        finally:
+            with server.lock:
+                server.running -= 1
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def _start_server(self, delay=0.2):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.lock = threading.Lock()
+        server.clients = set()
+        server.running = 0
+        server.max_running = 0
+        server.delay = delay
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.addCleanup(stop)
+        return server, "http://127.0.0.1:%i" % (server.server_address[1])
+
+    def _downloader(self, **kwargs):
+        dl = Downloader(**kwargs)
+        self.addCleanup(dl.close)
+        return dl
+
+    def test_connection_reuse(self):
+        server, url = self._start_server()
+        dl = self._downloader()
+        for i in range(5):
+            resp = dl.fetch(url + "/data%i" % (i)).result()
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp.data, bytes("/data%i" % (i), 'utf-8'))
+        # all requests were sent over the same connection
+        self.assertEqual(len(server.clients), 1)
+
+    def test_per_host_limit(self):
+        slow_server, slow_url = self._start_server(delay=0.3)
+        server, url = self._start_server()
+        dl = self._downloader(max_downloads=3, max_per_host=2)
+        slow = [dl.fetch(slow_url + "/slow%i" % (i)) for i in range(6)]
+        fast = dl.fetch(url + "/data")
+
+        # requests waiting for the busy host don't keep the other host waiting
+        self.assertEqual(fast.result(timeout=0.25).data, b"/data")
+        self.assertFalse(all(f.done() for f in slow))
+
+        for i, f in enumerate(slow):
+            self.assertEqual(f.result().data, bytes("/slow%i" % (i), 'utf-8'))
+        self.assertEqual(slow_server.max_running, 2)
+
+    def test_redirect(self):
+        server, url = self._start_server()
+        dl = self._downloader()
+        resp = dl.fetch(url + "/redirect").result()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.url, url + "/data")
+        self.assertEqual(resp.data, b"/data")
+
+        with self.assertRaises(DownloadError):
+            dl.fetch(url + "/loop").result()
+
+    def test_not_modified(self):
+        server, url = self._start_server()
+        dl = self._downloader()
+        self.assertEqual(dl.fetch(url + "/cached").result().status, 200)
+        resp = dl.fetch(url + "/cached", {'If-None-Match': '"abc"'}).result()
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(resp.data, b'')
+        resp = dl.fetch(url + "/cached", {'If-Modified-Since': "Sat, 01 Oct 2016 00:00:00 GMT"}).result()
+        self.assertEqual(resp.status, 304)
+
+    def test_deadline(self):
+        server, url = self._start_server(delay=2)
+        start = time.time()
+        dl = self._downloader(max_per_host=1, deadline=start + 0.5)
+        running = dl.fetch(url + "/slow1")
+        queued = dl.fetch(url + "/slow2")
+
+        with self.assertRaises(DownloadError):
+            running.result()
+        with self.assertRaises(DownloadError):
+            queued.result()
+        self.assertLess(time.time() - start, 1.5)
+        # the queued request was never sent
+        self.assertEqual(server.max_running, 1)
+
+        with self.assertRaises(DownloadError):
+            dl.fetch(url + "/data").result()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from dep11 import DataCache, MetadataExtractor
+from dep11 import workerpool
+from dep11.generator import extract_metadata
+
+
+METAINFO_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<component type="font">
+  <id>org.example.Test</id>
+  <name>Test</name>
+  <summary>A test component</summary>
+  <description><p>Just for testing.</p></description>
+  <screenshots>
+    <screenshot type="default">
+      <image>http://localhost/screenshot.png</image>
+    </screenshot>
+  </screenshots>
+</component>
+'''
+
+
+class FakeIconHandler:
+
+    def fetch_icon(self, cpt, pkg, export_path):
+        return False
+
+    def icon_cache_stats(self):
+        return (0, 0)
+
+    def close_packages(self):
+        pass
+
+
+class FakeDebFile:
+
+    def __init__(self, files):
+        self._files = files
+
+    def scan_interesting(self):
+        return list(self._files.keys())
+
+    def get_files_data(self, fnames):
+        return {fname: self._files[fname] for fname in fnames if fname in self._files}
+
+
+class FakePackage:
+
+    def __init__(self, files):
+        self.name = "test"
+        self.version = "1.0"
+        self.arch = "amd64"
+        self.pkid = "test/1.0/amd64"
+        self.filename = "pool/main/t/test/test_1.0_amd64.deb"
+        self.debfile = FakeDebFile(files)
+
+    def has_description(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class ExtractorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._cache = DataCache(os.path.join(self._dir, "media"))
+        self._cache.open(os.path.join(self._dir, "cache"))
+
+    def tearDown(self):
+        self._cache.close()
+        shutil.rmtree(self._dir)
+
+    def test_result_with_screenshots_is_picklable(self):
+        mde = MetadataExtractor("sid", "main", "amd64", self._cache, FakeIconHandler(), None)
+        workerpool._shared_objects['mde'] = mde
+        try:
+            pkg = FakePackage({'usr/share/metainfo/org.example.Test.metainfo.xml': bytes(METAINFO_XML, 'utf-8')})
+            result = extract_metadata('mde', "sid", pkg)
+        finally:
+            del workerpool._shared_objects['mde']
+
+        # the components still need their screenshots, so they are sent back unserialized
+        cpts, screenshot_cpts = result[2]
+        self.assertEqual(len(cpts), 1)
+        self.assertEqual(len(screenshot_cpts), 1)
+
+        # the result is sent from the worker to the main process
+        cpts, screenshot_cpts = pickle.loads(pickle.dumps(result))[2]
+        self.assertEqual(cpts[0].cid, "org.example.Test")
+        self.assertEqual(len(cpts[0].screenshots), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
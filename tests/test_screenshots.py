@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Matthias Klumpp <mak@debian.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.
+
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from PIL import Image
+
+from dep11.screenshots import store_screenshot, get_thumbnail_sizes
+
+
+class ScreenshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self._blob_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._blob_dir)
+
+    def _store(self, img):
+        data = BytesIO()
+        img.save(data, format="PNG")
+        store_screenshot(self._blob_dir, data.getvalue())
+
+    def _check_thumbnails(self, width, height):
+        sizes = get_thumbnail_sizes(width, height)
+        self.assertTrue(sizes)
+        for size in sizes:
+            thumb = Image.open(os.path.join(self._blob_dir, "%s.png" % (size)))
+            self.assertEqual("%ix%i" % thumb.size, size)
+
+    def test_palette_screenshot(self):
+        img = Image.new('RGB', (2560, 1440), 'blue').convert('P')
+        self._store(img)
+        self.assertTrue(os.path.isfile(os.path.join(self._blob_dir, "source.png")))
+        self._check_thumbnails(2560, 1440)
+
+    def test_bilevel_screenshot(self):
+        self._store(Image.new('1', (1920, 1080), 1))
+        self._check_thumbnails(1920, 1080)
+
+    def test_rgb_screenshot(self):
+        self._store(Image.new('RGB', (1920, 1080), 'red'))
+        self._check_thumbnails(1920, 1080)
+
+
+if __name__ == '__main__':
+    unittest.main()